@@ -0,0 +1,525 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 *
+""" Persistent on-disk cache for web responses.
+
+Every response that getContent downloads is stored on disk under the sha256
+of its URL: the body in <key>.body and the final (redirected) URL, status,
+headers and time it was stored in <key>.json. A repeated request for the same
+URL is answered from disk while the entry is younger than the TTL of its
+host. Older entries are revalidated with If-None-Match/If-Modified-Since, so
+an unchanged page only costs a 304 response. The total size of the cache is
+bounded, and the least recently used entries are removed first.
+
+QueryCache sits in front of that for searches: it maps a normalized search
+query straight to the imdb IDs found for it, so a repeated search is a
+dictionary lookup. It is kept in memory and appended to a log file next to
+the cached responses, which is read back on first use.
+
+"""
+
+
+import hashlib
+import json
+import os
+import threading
+import time
+import urllib.parse
+import http.client
+from collections import OrderedDict
+
+CACHE_DIR = os.environ.get(
+    'MINISCRAPE_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.miniscrape', 'http'))
+# Upper bound of the size of all cached bodies
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+# Seconds a cached response is used without asking the server again
+DEFAULT_TTL = 24 * 60 * 60
+HOST_TTLS = {
+    'www.bing.com': 6 * 60 * 60,
+    'www.imdb.com': 7 * 24 * 60 * 60,
+    # Posters are kept by the poster store in addmovie_poster_util
+    'ia.media-imdb.com': 0,
+}
+# Fraction of MAX_CACHE_BYTES the cache is trimmed to when it is full
+EVICT_TO = 0.9
+QUERY_CACHE_PATH = os.path.join(CACHE_DIR, 'queries.jsonl')
+# Number of search queries whose imdb IDs are remembered
+MAX_QUERIES = 10000
+# Seconds the imdb IDs found for a query are used without searching again
+QUERY_TTL = 7 * 24 * 60 * 60
+
+
+class CacheEntry:
+    """ Metadata of one cached response.
+
+    """
+
+    def __init__(self, key, meta):
+        self.key = key
+        self.url = meta['url']
+        self.finalURL = meta['finalURL']
+        self.status = meta['status']
+        self.headers = meta['headers']
+        self.storedAt = meta['storedAt']
+        self.hasBody = meta['hasBody']
+        self.size = meta['size']
+        # False if only the beginning of the body was read and stored
+        self.complete = meta.get('complete', True)
+
+    def toMeta(self):
+        return {'url': self.url, 'finalURL': self.finalURL,
+                'status': self.status, 'headers': self.headers,
+                'storedAt': self.storedAt, 'hasBody': self.hasBody,
+                'size': self.size, 'complete': self.complete}
+
+    def header(self, name):
+        name = name.lower()
+        for k, v in self.headers:
+            if k.lower() == name:
+                return v
+        return None
+
+
+class CachedResponse:
+    """ Response read from the cache. It has the same read() and geturl()
+    methods as PooledResponse. The body file is opened right away, so the
+    response can still be read if the entry is evicted meanwhile. Raises
+    OSError if the body is gone already, see ResponseCache.openResponse.
+
+    """
+
+    def __init__(self, cache, entry):
+        self._cache = cache
+        self._entry = entry
+        self._file = None
+        if entry.hasBody:
+            self._file = open(cache.bodyPath(entry.key), 'rb')
+        self.url = entry.finalURL
+        self.status = entry.status
+        self.reason = 'OK'
+        self.headers = http.client.HTTPMessage()
+        for k, v in entry.headers:
+            self.headers[k] = v
+        self.fromCache = True
+
+    def read(self, amt=None):
+        if self._file is None:
+            return b''
+        data = self._file.read() if amt is None else self._file.read(amt)
+        if not data or amt is None:
+            self.close()
+        return data
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.status
+
+    def info(self):
+        return self.headers
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def closeEarly(self):
+        """ Stop reading before the end of the body.
+
+        """
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CachingResponse:
+    """ Wraps a PooledResponse and stores the body in the cache once it has
+    been read to the end.
+
+    """
+
+    def __init__(self, cache, url, resp):
+        self._cache = cache
+        self._url = url
+        self._resp = resp
+        self._chunks = []
+        self._stored = False
+        self.url = resp.url
+        self.status = resp.status
+        self.reason = resp.reason
+        self.headers = resp.headers
+        self.fromCache = False
+
+    def read(self, amt=None):
+        data = self._resp.read(amt)
+        if self._stored:
+            return data
+        self._chunks.append(data)
+        if amt is None or not data:
+            self._store()
+        return data
+
+    def _store(self, complete=True):
+        self._stored = True
+        body = b''.join(self._chunks)
+        self._chunks = []
+        self._cache.put(self._url, self.url, self.status,
+                        self.headers.items(), body, complete)
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.status
+
+    def info(self):
+        return self.headers
+
+    def close(self):
+        self._chunks = []
+        self._resp.close()
+
+    def closeEarly(self):
+        """ Stop reading before the end of the body. The part read so far
+        is cached as a partial entry, which is only used by callers of
+        getContent that ask for allowPartial.
+
+        """
+        if not self._stored and self._chunks:
+            self._store(complete=False)
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ResponseCache:
+    """ Size bounded LRU cache of web responses stored in directory.
+
+    Parameters
+    ----------
+    directory : string
+        where the cached files are written
+    maxBytes : int
+        the least recently used entries are removed once the cached bodies
+        take more space than this
+    hostTTLs : dictionary
+        seconds a response is fresh, per host name
+    defaultTTL : int
+        seconds a response is fresh for hosts not in hostTTLs. A TTL of 0
+        disables caching for that host.
+
+    """
+
+    def __init__(self, directory=CACHE_DIR, maxBytes=MAX_CACHE_BYTES,
+                 hostTTLs=HOST_TTLS, defaultTTL=DEFAULT_TTL):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.hostTTLs = dict(hostTTLs)
+        self.defaultTTL = defaultTTL
+        self._lock = threading.Lock()
+        # key -> [lastUsed, size]. Loaded from disk on first use.
+        self._index = None
+        self._totalBytes = 0
+
+    @staticmethod
+    def keyFor(url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def metaPath(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def bodyPath(self, key):
+        return os.path.join(self.directory, key[:2], key + '.body')
+
+    def ttlFor(self, url):
+        host = urllib.parse.urlsplit(url).hostname or ''
+        return self.hostTTLs.get(host, self.defaultTTL)
+
+    def isFresh(self, entry):
+        return time.time() - entry.storedAt < self.ttlFor(entry.url)
+
+    def get(self, url):
+        """ Return the CacheEntry for url, or None if it is not cached.
+        The entry may be stale, check it with isFresh.
+
+        """
+        if self.ttlFor(url) <= 0:
+            return None
+        key = self.keyFor(url)
+        try:
+            with open(self.metaPath(key), encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        entry = CacheEntry(key, meta)
+        self._touch(key, entry.size)
+        return entry
+
+    def openResponse(self, entry):
+        """ Return a CachedResponse for entry, or None if its body was
+        removed since get returned it. The entry is forgotten then.
+
+        """
+        try:
+            return CachedResponse(self, entry)
+        except OSError:
+            self.remove(entry.key)
+            return None
+
+    def conditionalHeaders(self, entry):
+        """ Request headers that revalidate entry with the server.
+
+        """
+        headers = {}
+        etag = entry.header('ETag')
+        if etag:
+            headers['If-None-Match'] = etag
+        lastModified = entry.header('Last-Modified')
+        if lastModified:
+            headers['If-Modified-Since'] = lastModified
+        return headers
+
+    def put(self, url, finalURL, status, headers, body=None, complete=True):
+        """ Store a response. body is None for entries that only remember
+        where url redirects to. complete is False if body is only the
+        beginning of the response.
+
+        """
+        if self.ttlFor(url) <= 0 or status != 200:
+            return None
+        headers = [(k, v) for k, v in headers]
+        for k, v in headers:
+            if k.lower() == 'cache-control' and 'no-store' in v.lower():
+                return None
+        key = self.keyFor(url)
+        entry = CacheEntry(key, {
+            'url': url, 'finalURL': finalURL, 'status': status,
+            'headers': headers, 'storedAt': time.time(),
+            'hasBody': body is not None,
+            'size': len(body) if body is not None else 0,
+            'complete': complete})
+        try:
+            os.makedirs(os.path.dirname(self.metaPath(key)), exist_ok=True)
+            if body is not None:
+                self._writeAtomic(self.bodyPath(key), body)
+            self._writeAtomic(self.metaPath(key),
+                              json.dumps(entry.toMeta()).encode('utf-8'))
+        except OSError as e:
+            print("Could not write cache entry for {0}, {1}".format(url, e))
+            return None
+        self._touch(key, entry.size)
+        self._evict()
+        return entry
+
+    def refresh(self, entry, headers):
+        """ The server answered 304 Not Modified for entry. Restart its TTL
+        and keep the new validators.
+
+        """
+        newHeaders = dict((k.lower(), (k, v)) for k, v in entry.headers)
+        for k, v in headers.items():
+            if k.lower() in ('etag', 'last-modified', 'date',
+                             'cache-control', 'expires'):
+                newHeaders[k.lower()] = (k, v)
+        entry.headers = list(newHeaders.values())
+        entry.storedAt = time.time()
+        try:
+            self._writeAtomic(self.metaPath(entry.key),
+                              json.dumps(entry.toMeta()).encode('utf-8'))
+        except OSError as e:
+            print("Could not refresh cache entry for {0}, {1}"
+                  .format(entry.url, e))
+
+    def remove(self, key):
+        with self._lock:
+            if self._index is not None and key in self._index:
+                self._totalBytes -= self._index.pop(key)[1]
+        for path in (self.metaPath(key), self.bodyPath(key)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _writeAtomic(self, path, data):
+        tmp = '{0}.{1}.{2}.tmp'.format(path, os.getpid(),
+                                       threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _loadIndex(self):
+        """ Build the LRU index from the files on disk. The mtime of a meta
+        file is the last time the entry was used.
+
+        """
+        index = {}
+        total = 0
+        if os.path.isdir(self.directory):
+            for sub in os.listdir(self.directory):
+                subdir = os.path.join(self.directory, sub)
+                if not os.path.isdir(subdir):
+                    continue
+                for name in os.listdir(subdir):
+                    if not name.endswith('.json'):
+                        continue
+                    key = name[:-len('.json')]
+                    try:
+                        lastUsed = os.stat(os.path.join(subdir, name)).st_mtime
+                        bodyPath = self.bodyPath(key)
+                        size = (os.stat(bodyPath).st_size
+                                if os.path.exists(bodyPath) else 0)
+                    except OSError:
+                        continue
+                    index[key] = [lastUsed, size]
+                    total += size
+        self._index = index
+        self._totalBytes = total
+
+    def _touch(self, key, size):
+        now = time.time()
+        with self._lock:
+            if self._index is None:
+                self._loadIndex()
+            old = self._index.get(key)
+            if old is not None:
+                self._totalBytes -= old[1]
+            self._index[key] = [now, size]
+            self._totalBytes += size
+        try:
+            os.utime(self.metaPath(key), (now, now))
+        except OSError:
+            pass
+
+    def _evict(self):
+        with self._lock:
+            if self._totalBytes <= self.maxBytes:
+                return
+            excess = self._totalBytes - self.maxBytes * EVICT_TO
+            victims = []
+            for key, (lastUsed, size) in sorted(self._index.items(),
+                                                key=lambda kv: kv[1][0]):
+                if excess <= 0:
+                    break
+                victims.append(key)
+                excess -= size
+        for key in victims:
+            self.remove(key)
+
+
+class QueryCache:
+    """ LRU cache of the imdb IDs found for search queries, with a TTL.
+    Every put is appended to the log file at path as a JSON line. The log
+    is rewritten with only the live entries once it has twice as many
+    lines as the cache can hold.
+
+    Parameters
+    ----------
+    path : string
+        the log file
+    maxQueries : int
+        number of queries kept. The least recently used are dropped first.
+    ttl : int
+        seconds the imdb IDs of a query are used
+
+    """
+
+    def __init__(self, path=QUERY_CACHE_PATH, maxQueries=MAX_QUERIES,
+                 ttl=QUERY_TTL):
+        self.path = path
+        self.maxQueries = maxQueries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # query -> (storedAt, imdbIDs). Loaded from the log on first use.
+        self._entries = None
+        self._logLines = 0
+
+    def get(self, query):
+        """ Return a copy of the imdb IDs stored for query, or None if it is
+        not cached or has expired.
+
+        """
+        with self._lock:
+            if self._entries is None:
+                self._load()
+            entry = self._entries.get(query)
+            if entry is None:
+                return None
+            if time.time() - entry[0] >= self.ttl:
+                del self._entries[query]
+                return None
+            self._entries.move_to_end(query)
+            return list(entry[1])
+
+    def put(self, query, imdbIDs):
+        if self.ttl <= 0:
+            return
+        storedAt = time.time()
+        imdbIDs = list(imdbIDs)
+        with self._lock:
+            if self._entries is None:
+                self._load()
+            self._entries[query] = (storedAt, imdbIDs)
+            self._entries.move_to_end(query)
+            while len(self._entries) > self.maxQueries:
+                self._entries.popitem(last=False)
+            try:
+                if self._logLines >= 2 * self.maxQueries:
+                    self._compact()
+                else:
+                    self._append([query, storedAt, imdbIDs])
+            except OSError as e:
+                print("Could not write query cache {0}, {1}"
+                      .format(self.path, e))
+
+    def _load(self):
+        entries = OrderedDict()
+        lines = 0
+        now = time.time()
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        query, storedAt, imdbIDs = json.loads(line)
+                    except ValueError:
+                        # a line cut short by a crash
+                        continue
+                    entries.pop(query, None)
+                    if now - storedAt < self.ttl:
+                        entries[query] = (storedAt, imdbIDs)
+        except OSError:
+            pass
+        while len(entries) > self.maxQueries:
+            entries.popitem(last=False)
+        self._entries = entries
+        self._logLines = lines
+
+    def _append(self, record):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+        self._logLines += 1
+
+    def _compact(self):
+        tmp = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for query, (storedAt, imdbIDs) in self._entries.items():
+                f.write(json.dumps([query, storedAt, imdbIDs]) + '\n')
+        os.replace(tmp, self.path)
+        self._logLines = len(self._entries)
+
+
+# The caches shared by the whole application
+cache = ResponseCache()
+queryCache = QueryCache()
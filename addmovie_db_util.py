@@ -2,31 +2,381 @@
 # -*- coding: utf-8 *
 """ Helper methods for database access.
 
-The database code has been commented out but you can change this for your
-database setup.
+Movies are stored in a local SQLite database (MINISCRAPE_DB, by default
+~/.miniscrape/movies.db) in WAL mode, with a unique index on imdbID.
+insert2DB doesn't write to the database itself. It hands the movie to
+MovieStore's write-behind thread, which upserts queued movies in batches of
+up to BATCH_SIZE per transaction, so neither the GUI nor batch mode waits on
+the disk for every movie. alreadyExist sees movies that are still queued as
+well as the ones already committed. If a batch can't be written, its
+movies are written one at a time, and the ones that still fail are printed
+and forgotten, so they don't count as stored.
+
+The imdbIDs of all stored movies are also kept in memory in a Bloom filter
+that is loaded when the database is opened and updated by insert2DB. Most
+alreadyExist and isKnownID checks are for new movies, and the filter
+answers those without touching the database. Only IDs the filter may
+contain are checked exactly with a query.
+
+The original MySQL code is kept commented out below if you want to change
+this for your database setup.
 
 """
 
 
+import atexit
+import hashlib
+import math
+import os
+import queue
+import sqlite3
+import threading
+import time
+
 # import MySQLdb
 # from makedb.globalz import cursor
 
-def alreadyExist(movieDict):
+DB_PATH = os.environ.get(
+    'MINISCRAPE_DB',
+    os.path.join(os.path.expanduser('~'), '.miniscrape', 'movies.db'))
+# Largest number of movies written in one transaction
+BATCH_SIZE = 500
+# Seconds the writer waits for more movies before it commits a batch
+FLUSH_INTERVAL = 0.2
+# Smallest number of imdbIDs the Bloom filter is sized for
+INDEX_CAPACITY = 100000
+# Fraction of unknown IDs the Bloom filter wrongly reports as known
+INDEX_ERROR_RATE = 0.001
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS movies (
+    movID INTEGER PRIMARY KEY AUTOINCREMENT,
+    imdbID TEXT NOT NULL,
+    imageURL TEXT,
+    title TEXT,
+    year INTEGER,
+    pbmovname TEXT,
+    hashX TEXT,
+    type TEXT,
+    amazonID TEXT,
+    lastupdate TEXT,
+    rtmatch INTEGER DEFAULT 0,
+    inQueue INTEGER DEFAULT 0,
+    downloaded INTEGER DEFAULT 0,
+    dlnormal INTEGER DEFAULT 0,
+    audified INTEGER DEFAULT 0,
+    hashified INTEGER DEFAULT 0,
+    uploaded INTEGER DEFAULT 0,
+    mastersubhere INTEGER DEFAULT 0,
+    subprocessed INTEGER DEFAULT 0,
+    mastersub1found INTEGER DEFAULT 0,
+    done INTEGER DEFAULT 0
+);
+CREATE UNIQUE INDEX IF NOT EXISTS movies_imdbID ON movies (imdbID);
+"""
+
+# Same columns and update rules as the ON DUPLICATE KEY UPDATE of the MySQL
+# code below
+UPSERT = """
+INSERT INTO movies (imdbID, imageURL, title, year, pbmovname, hashX, type,
+                    amazonID, lastupdate)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (imdbID) DO UPDATE SET
+    pbmovname = excluded.pbmovname, hashX = excluded.hashX,
+    amazonID = excluded.amazonID, lastupdate = excluded.lastupdate,
+    rtmatch = 0, inQueue = 0, downloaded = 0, dlnormal = 0, audified = 0,
+    hashified = 0, uploaded = 0, mastersubhere = 0, subprocessed = 0,
+    mastersub1found = 0, done = 0
+"""
+
+
+def movieRow(movie):
+    """ Return the values of the MovieRecord movie in the order of the
+    UPSERT columns.
+
+    """
+    year = str(movie.year)
+    return (movie.imdbID, movie.imageURL, movie.title,
+            int(year) if year.isdigit() else 0, movie.movname or "",
+            movie.hashX or "", movie.type, movie.amazonID or "",
+            time.strftime('%Y-%m-%d %H:%M:%S'))
+
+
+class BloomFilter:
+    """ Compact set of strings that can report false positives but never
+    false negatives.
+
+    Parameters
+    ----------
+    capacity : int
+        number of keys the filter is sized for
+    errorRate : float
+        false positive rate when capacity keys have been added
+
+    """
+
+    def __init__(self, capacity, errorRate=INDEX_ERROR_RATE):
+        self.capacity = capacity
+        self.numBits = max(8, int(-capacity * math.log(errorRate) /
+                                  math.log(2) ** 2))
+        self.numHashes = max(1, round(self.numBits / capacity * math.log(2)))
+        self.bits = bytearray((self.numBits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'),
+                                 digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.numBits for i in range(self.numHashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(key))
+
+
+def connect(path):
+    """ Open the database at path in WAL mode and create the schema.
+
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+class MovieStore:
+    """ SQLite movie table with a write-behind queue.
+
+    Parameters
+    ----------
+    path : string
+        the SQLite database file
+    batchSize : int
+        largest number of movies committed in one transaction
+
+    """
+
+    def __init__(self, path=DB_PATH, batchSize=BATCH_SIZE):
+        self.path = path
+        self.batchSize = batchSize
+        self._conn = connect(path)
+        self._readLock = threading.Lock()
+        self._queue = queue.Queue()
+        # imdbID -> row of movies queued but not committed yet
+        self._pending = {}
+        self._pendingLock = threading.Lock()
+        self._indexLock = threading.Lock()
+        self._loadIndex(INDEX_CAPACITY)
+        self._writer = threading.Thread(target=self._writeLoop,
+                                         name='MovieStore writer',
+                                         daemon=True)
+        self._writer.start()
+
+    def _loadIndex(self, capacity):
+        """ Build the Bloom filter from the imdbIDs in the database.
+
+        """
+        imdbIDs = set(self.imdbIDs())
+        index = BloomFilter(max(capacity, 2 * len(imdbIDs)))
+        for imdbID in imdbIDs:
+            index.add(imdbID)
+        self.index = index
+
+    def insert(self, movie):
+        """ Queue the MovieRecord movie to be upserted. Returns right away.
+
+        """
+        row = movieRow(movie)
+        with self._pendingLock:
+            self._pending[row[0]] = row
+        with self._indexLock:
+            if row[0] not in self.index:
+                if self.index.count >= self.index.capacity:
+                    # Full filters give too many false positives. Grow it.
+                    # The new one has the row, it is in _pending already.
+                    self._loadIndex(2 * self.index.capacity)
+                else:
+                    self.index.add(row[0])
+        self._queue.put(row)
+
+    def contains(self, imdbID):
+        """ Return True if imdbID is stored or queued. IDs that are not in
+        the Bloom filter are answered without a query.
+
+        """
+        if imdbID not in self.index:
+            return False
+        return self.find(imdbID) is not None
+
+    def find(self, imdbID):
+        """ Return (movID, pbmovname, hashX) of the stored movie, or None.
+        movID is None for a movie that is still queued.
+
+        """
+        with self._pendingLock:
+            row = self._pending.get(imdbID)
+        if row is not None:
+            return (None, row[4], row[5])
+        with self._readLock:
+            return self._conn.execute(
+                'SELECT movID, pbmovname, hashX FROM movies '
+                'WHERE imdbID = ?', (imdbID,)).fetchone()
+
+    def imdbIDs(self):
+        """ Yield the imdbID of every stored and queued movie.
+
+        """
+        with self._pendingLock:
+            pending = list(self._pending)
+        with self._readLock:
+            rows = self._conn.execute('SELECT imdbID FROM movies').fetchall()
+        for row in rows:
+            yield row[0]
+        for imdbID in pending:
+            yield imdbID
+
+    def flush(self):
+        """ Wait until every queued movie is committed.
+
+        """
+        self._queue.join()
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._writer.join()
+        self._conn.close()
+
+    def _updateIndexCount(self, conn):
+        """ insert only counts the movies the Bloom filter reports as new,
+        so new movies that were false positives are missed. Catch up with
+        the number of stored movies, and grow the filter if it is full.
+
+        """
+        try:
+            numRows = conn.execute('SELECT COUNT(*) FROM movies').fetchone()[0]
+        except sqlite3.Error:
+            return
+        with self._indexLock:
+            if numRows > self.index.count:
+                self.index.count = numRows
+                if self.index.count >= self.index.capacity:
+                    self._loadIndex(2 * self.index.capacity)
+
+    def _writeBatch(self, conn, batch):
+        """ Upsert batch in one transaction. If that fails, the rows are
+        written one at a time so a single bad row doesn't lose the others.
+        Returns the rows that could not be written.
+
+        """
+        try:
+            with conn:
+                conn.executemany(UPSERT, batch)
+            return []
+        except sqlite3.Error as e:
+            if len(batch) == 1:
+                errors = [(batch[0], e)]
+            else:
+                errors = []
+                for row in batch:
+                    try:
+                        with conn:
+                            conn.execute(UPSERT, row)
+                    except sqlite3.Error as rowError:
+                        errors.append((row, rowError))
+        for row, error in errors:
+            print("Could not write {0} to {1}, {2}"
+                  .format(row[0], self.path, error))
+        return [row for row, error in errors]
+
+    def _writeLoop(self):
+        conn = connect(self.path)
+        while True:
+            row = self._queue.get()
+            if row is None:
+                self._queue.task_done()
+                break
+            batch = [row]
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            stop = False
+            while len(batch) < self.batchSize:
+                try:
+                    row = self._queue.get(
+                        timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if row is None:
+                    stop = True
+                    break
+                batch.append(row)
+            failed = self._writeBatch(conn, batch)
+            with self._pendingLock:
+                for row in batch:
+                    if self._pending.get(row[0]) is row:
+                        del self._pending[row[0]]
+            if failed:
+                # A Bloom filter can't forget keys. Build it again without
+                # the movies that were not stored.
+                with self._indexLock:
+                    self._loadIndex(self.index.capacity)
+            else:
+                self._updateIndexCount(conn)
+            for _ in range(len(batch) + stop):
+                self._queue.task_done()
+            if stop:
+                break
+        conn.close()
+
+
+_store = None
+_storeLock = threading.Lock()
+
+
+def getStore():
+    """ Return the MovieStore shared by the application. It is opened on
+    first use and flushed when the program exits.
+
+    """
+    global _store
+    with _storeLock:
+        if _store is None:
+            _store = MovieStore()
+            atexit.register(_store.close)
+        return _store
+
+
+def alreadyExist(movie):
     """ Check if movie that we want to add is already in the database.
-    This is commented out for github. Implement your own method to check db
-    here. Right now it always returns False.
 
     Parameters
     ----------
-    movieDict : dictonary containing movie's info
+    movie : MovieRecord containing movie's info
 
     Returns
     -------
     exists : bool
-        returned value tells whether movieDict already exists in db
+        returned value tells whether movie already exists in db
     """
-    return False
-    # Uncomment below to check if this movie is already in database
+    store = getStore()
+    if movie.imdbID not in store.index:
+        return False
+    row = store.find(movie.imdbID)
+    if row is not None:
+        movie.movID_old = row[0]
+        return True
+    else:
+        return False
     # cursor.execute('SELECT movID, pbmovname, hashX FROM'
                    # 'subtitleserver_movies WHERE imdbID = %(imdbID)s',
                    # movieDict)
@@ -38,16 +388,29 @@ def alreadyExist(movieDict):
     #   return False
 
 
-def insert2DB(movieDict):
-    """ Insert the selected movie into the database. This is commented out below.
-    It just prints the movie's dictionary into stdout.
+def isKnownID(imdbID):
+    """ Check if the movie with imdbID ('tt' prefix included) is already in
+    the database. Most unknown IDs are answered from memory, so this is
+    cheap enough to call before every scrape.
+
+    """
+    return getStore().contains(imdbID)
+
+
+def insert2DB(movie, verbose=True):
+    """ Insert the selected movie into the database, or update it if it is
+    already there. The write happens in the background, see MovieStore.
 
     Parameters
     ----------
-    movieDict : dictonary containing movie's info
+    movie : MovieRecord containing movie's info
+    verbose : bool
+        also print the movie's fields into stdout
 
     """
-    print(movieDict)
+    if verbose:
+        print(movie.toDict())
+    getStore().insert(movie)
     # cursor.execute('INSERT INTO subtitleserver_movies (imdbID, imageURL,'
     #                'title, year, pbmovname, hashX, type, amazonID,'
     #                'lastupdate) VALUES (\"{0[imdbID]}\", \"{0[imageURL]}\",'
@@ -7,41 +7,74 @@ components to different functions also in the AddMovieGUI class. We also
 included lots of keyboard shortcuts to make usage more efficient. 
 
 AddMovieGUI has a textbox (searchTextBox) for the user to query a movie name.
-Pressing enter starts a thread executing searchPressed(), which retrieves the
-IMDB ID's from Bing and then scrapes data from each of the corresponding IMDB
-pages. The data includes the IMDB image URL, title, year, and (importantly)
-the Amazon ASIN. It stores the data in the instance variable movieList, then
-pushes the string message "movie searched" to the queue. Messages are popped
-from the queue regularly in the processIncoming method by the worker thread
-created in class ThreadedClient. The worker thread reads the message "movie
-searched" and calls searchPressed2() to update the GUI (movieListBox) with
-the new movies stored in the instance variable movieList. 
+Searches start by themselves once the user stops typing for SEARCH_DELAY_MS,
+or right away when enter is pressed. Each search gets a new generation
+number, and results of older generations are dropped, so a slow earlier
+query can never overwrite the results of a newer one. The results of the
+previous search are cleared as soon as a new one starts.
+A search starts a thread executing searchPressed(), which retrieves the
+IMDB ID's from the offline title index or Bing (imdbSearch) and then scrapes
+data from all the corresponding IMDB pages at the same time. The data includes the IMDB image URL, title, year,
+and the link to the movie's Amazon page. Every movie is pushed to the queue
+in a MovieFound message with the search generation as soon as its page is
+scraped, and a MovieSearched message follows once all pages are done. The
+message types are defined in addmovie_queue_util. The queue wakes the Tk
+main loop up as soon as a message is put, and processIncoming then handles
+every pending message. For every MovieFound, movieFound() appends the movie
+to the instance variable movieList and to movieListBox, so the results show
+up one by one in the order they arrive and rows never move once shown.
+MovieSearched calls searchPressed2() to finish the search.
 
 The movie poster for the selected movie will also be displayed in imgPanel.
-The logic for that is in movieListChanged(). If no image is available,
-clearImg() is called to display the default image in the img subdirectory.
+The logic for that is in movieListChanged(). Posters that are not already in
+memory are loaded by a PosterLoader worker, which pushes a PosterLoaded
+message to the queue once the poster is decoded. Until then, or if no image
+is available, clearImg() is called to display the default image in the img
+subdirectory.
+
+The Amazon ASIN, and whatever else the stages in addmovie_pipeline_util
+add, is only looked up for movies the user selects. Selecting a movie
+starts enriching it in the background, and submitting a movie that still
+has pending stages waits for them on a thread, which pushes a MovieEnriched
+message to the queue when it's done. If a stage failed or timed out, the
+movie is not stored and the status bar says which lookup failed, so it can
+be submitted again.
 
 When a movie in the movieListBox is selected, pressing enter or double
 clicking on the movie will print the selected movie's dictonary info to stdout. 
 The output behavior can be modified in insert2DB() in addmovie_db_util.py to
 store the movie data in your database, for example.
 
+Every search is timed as the search stage of addmovie_metrics_util, next to
+the stages it is made of, and is profiled with cProfile when
+MINISCRAPE_PROFILE_DIR is set.
+
 """
 
 
 import queue
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
 
 from tkinter import Text, Listbox, Label, Entry, NORMAL, END, DISABLED, \
-    SEL, INSERT, DISABLED
-from PIL import Image, ImageTk
-
-from addmovie_web_util import imdbBingSearch, bsIMDB, getContent
+    SEL, INSERT
+from PIL import ImageTk
+
+from addmovie_web_util import imdbSearch, bsIMDBMany
+from addmovie_pipeline_util import enrichMovie, pendingStages
+from addmovie_metrics_util import metrics
+from addmovie_poster_util import PosterLoader
+from addmovie_queue_util import MovieFound, MovieSearched, PosterLoaded, \
+    MovieEnriched
 from addmovie_db_util import insert2DB, alreadyExist
-from addmovie_gui_util import center, clearApp, clearImg
+from addmovie_gui_util import center, clearImg
 from replacepopup import ReplaceMoviePopUp
 
+# Milliseconds the user has to stop typing before a search starts
+SEARCH_DELAY_MS = 400
+# Shorter queries are only searched when enter is pressed
+MIN_QUERY_LENGTH = 3
+
 
 class AddMovieGUI:
 
@@ -54,11 +87,19 @@ class AddMovieGUI:
         queue : queue
             The queue that contain tasks for the GUI to update.
         end_app : function
-            call them to end the main thread calliing periodicCall
+            call them to stop handling the queue
         """
         self.queue = queue
         self.master = master
         self.end_app = end_app
+        self.movieList = []
+        # Incremented for every search. Results of older searches are dropped
+        self.searchGeneration = 0
+        self.lastQuery = ""
+        self.searchJob = None
+        self.focusResults = False
+        self.posterLoader = PosterLoader(queue)
+        self.enrichPool = ThreadPoolExecutor(max_workers=2)
         master.wm_title("IMDB & Amazon Scraper")
         master.protocol("WM_DELETE_WINDOW", self._quit)
 
@@ -69,13 +110,15 @@ class AddMovieGUI:
         # Search TextBox
         self.searchTextBox = Text(master, height=1, width=WINDOW_WIDTH//2)
         self.searchTextBox.bind('<Return>', self.searchPressedEvent)
+        self.searchTextBox.bind('<KeyRelease>', self.searchTextChanged)
         self.searchTextBox.bind("<Control-Key-a>", self.select_all)
         self.searchTextBox.pack(pady=5, padx=WINDOW_WIDTH)
         self.searchTextBox.focus_set()
         self.searchTextBox.bind("<Tab>", self.focus_next_list_window)
 
         # Movie Results List
-        self.movieListBox = Listbox(master, width=WINDOW_WIDTH)
+        self.movieListBox = Listbox(master, width=WINDOW_WIDTH,
+                                    exportselection=False)
         self.movieListBox.pack(pady=5, padx=WINDOW_WIDTH)
         self.movieListBox.bind("<Return>", self.submitPressedEvent)
         self.movieListBox.bind("<Double-Button-1>", self.submitPressedEvent)
@@ -99,18 +142,28 @@ class AddMovieGUI:
         """ Handle all messages currently in the queue, if any.
 
         """
-        while self.queue.qsize():
+        while True:
             try:
-                msg = self.queue.get(0)
-                # after querying movie and getting results. Update GUI
-                if msg == "movie searched":
-                    self.searchPressed2()
-                else:
-                    raise Exception('unknown message in queue!')
+                msg = self.queue.get_nowait()
             except queue.Empty:
-                # just on general principles, although we don't
-                # expect this branch to be taken in this case
-                pass
+                break
+            # after querying movie and getting results. Update GUI
+            # ignore results of searches that were replaced
+            if isinstance(msg, MovieFound):
+                if msg.generation == self.searchGeneration:
+                    self.movieFound(msg.generation, msg.movie)
+            elif isinstance(msg, MovieSearched):
+                if msg.generation == self.searchGeneration:
+                    self.searchPressed2(msg.generation)
+            # a poster finished loading in the background
+            elif isinstance(msg, PosterLoaded):
+                self.posterLoaded(msg.imageURL, msg.image)
+            # the submitted movie was enriched
+            elif isinstance(msg, MovieEnriched):
+                if msg.movie is self.movie:
+                    self.movieEnriched(msg.statuses)
+            else:
+                raise Exception('unknown message in queue!')
 
     def select_all(self, event):
         """ Select all text in SearchTextBox. Bound to Ctrl-a
@@ -121,83 +174,195 @@ class AddMovieGUI:
         event.widget.see(INSERT)
         return 'break'
 
+    def searchTextChanged(self, event):
+        """ The user typed in searchTextBox. Search the new text once the
+        user stops typing for SEARCH_DELAY_MS.
+
+        """
+        if self.searchJob is not None:
+            self.master.after_cancel(self.searchJob)
+            self.searchJob = None
+        query = self.searchTextBox.get("1.0", END).strip()
+        if query != self.lastQuery and len(query) >= MIN_QUERY_LENGTH:
+            self.searchJob = self.master.after(SEARCH_DELAY_MS,
+                                               self.startSearch)
+
     def searchPressedEvent(self, event):
         """ Function called after user searched a movie name.
-        Initiate search to bing and update movieDict and movie poster
+        Initiate search to bing and update movieList and movie poster
+
+        """
+        self.focusResults = True
+        self.startSearch(force=True)
+        return "break"
+
+    def startSearch(self, force=False):
+        """ Start searching the text in searchTextBox on a new thread. The
+        search gets a new generation, which makes every older search that
+        is still running stop and drop its results.
+
+        Parameters
+        ----------
+        force : bool
+            search even if the text didn't change since the last search
 
         """
-        # Disable searchTextBox so users can't input another query
-        # while a query is already running
-        self.searchTextBox.config(state=DISABLED)
-        query = self.searchTextBox.get("1.0", END)
+        if self.searchJob is not None:
+            self.master.after_cancel(self.searchJob)
+            self.searchJob = None
+        query = self.searchTextBox.get("1.0", END).strip()
+        if not query or (query == self.lastQuery and not force):
+            return
+        self.lastQuery = query
+        self.searchGeneration += 1
+        # The old results can't be selected or submitted anymore
+        self.clearResults()
         self.insertStatusText("Searching movie: " + query)
-        clearApp(self)
+        # Posters of the previous results are not needed anymore
+        self.posterLoader.cancelPrefetch()
         # Start thread to search movie name.
-        Thread(target=self.searchPressed, args=(query,)).start()
-        return "break"
+        Thread(target=self.searchPressed,
+               args=(query, self.searchGeneration)).start()
 
-    def searchPressed(self, query):
-        """ Queries movie name and stores returned imdb ID's in self.movieList
+    def searchPressed(self, query, generation):
+        """ Queries movie name and sends the movies found for the returned
+        imdb ID's to the GUI
 
         Parameters
         ----------
         query : the query string
+        generation : int
+            the searchGeneration this search was started with
+
+        """
+        def cancelled():
+            return generation != self.searchGeneration
+
+        def scraped(movie):
+            # Called on a worker thread for every scraped movie. Start
+            # loading its poster and show the movie right away, unless the
+            # search was replaced.
+            if not cancelled():
+                self.prefetchPoster(movie)
+                self.queue.put(MovieFound(generation, movie))
+
+        with metrics.profiled('search-' + query), \
+                metrics.span('search', query):
+            # Get list of imdb IDs for a input query string
+            imdbIDs = imdbSearch(query)
+            if cancelled():
+                return
+            # Extract movie info for all imdbIDs at the same time
+            bsIMDBMany(imdbIDs, callback=scraped, cancelled=cancelled)
+        if cancelled():
+            return
+        # Put message into queue to tell the GUI all movies are found.
+        self.queue.put(MovieSearched(generation))
+
+    def prefetchPoster(self, movie):
+        """ Start loading the poster of a scraped movie so it can be shown
+        as soon as it's selected.
+
+        """
+        if movie.imageURL:
+            self.posterLoader.prefetch(movie.imageURL)
+
+    def clearResults(self):
+        """ Remove the movies of the previous search from movieList and
+        movieListBox and show the default image.
 
         """
-        # Get list of imdb IDs for a input query string
-        imdbIDs = imdbBingSearch(query)
         self.movieList = []
-        # Extract movie info for each imdbID and store in movieList dict.
-        for imdbID in imdbIDs:
-            imdbDict = bsIMDB(imdbID)
-            if imdbDict:
-                self.movieList.append(imdbDict)
-        # Put message into queue to update GUI with new movie list.
-        msg = "movie searched"
-        self.queue.put(msg)
-
-    def searchPressed2(self):
-        """ Update GUI after getting the movieList.
-        Put movie string (title, year, type) into movieListBox
-        Change focus to movieListBox
-        Update movie image
-        re-enable searchTextBox
-
-        """
-        # Insert movies found from bing into movieListBox
-        for movie in self.movieList:
-            self.movieListBox.insert(END, "{title} {year} {type}"
-                                     .format(**movie))
+        self.movieListBox.delete(0, END)
+        clearImg(self)
+
+    def movieFound(self, generation, movie):
+        """ Append a movie of the current search to movieList and put its
+        string (title, year, type) at the end of movieListBox. The first
+        movie is selected and its poster shown.
+
+        """
+        self.movieList.append(movie)
+        self.movieListBox.insert(END, movie.label())
+        if len(self.movieList) == 1:
+            self.movieListBox.select_set(0)
+            if self.focusResults:
+                self.focusResults = False
+                self.movieListBox.focus()
+            self.movieListChanged(None)
+
+    def searchPressed2(self, generation):
+        """ Update GUI after all movies of the search were found.
+        Clear movieListBox and the movie image if nothing was found
+
+        """
         self.insertStatusText("")
-        # Update movieListBox focus and movie image
-        self.movieListBox.select_set(0)
-        self.movieListBox.focus()
-        self.movieListChanged(None)
-        self.searchTextBox.config(state=NORMAL)
+        self.focusResults = False
+        if not self.movieList:
+            self.clearResults()
 
     def submitPressedEvent(self, event):
         """ User chooses a movie from movieListBox.
 
         """
-        if self.movieListBox.size() == 0:
+        selection = self.movieListBox.curselection()
+        if not selection or selection[0] >= len(self.movieList):
             return
 
         # Get selected movie in movieListBox
-        selection = self.movieListBox.curselection()[0]
-        self.movieDict = self.movieList[selection]
+        self.movie = self.movieList[selection[0]]
 
         # Form another query. Not used here. But this is used for further
         # web scraping on other sites (not shown).
-        self.movieDict['queryStr'] = "{title} {year}".format(**self.movieDict)
+        self.movie.queryStr = "{0} {1}".format(self.movie.title,
+                                               self.movie.year)
+
+        # Look up the Amazon ASIN and the other details first if they are
+        # not known yet
+        if not pendingStages(self.movie):
+            self.submitMovie()
+        else:
+            self.insertStatusText("Looking up Amazon ASIN")
+            Thread(target=self.enrichSubmitted,
+                   args=(self.movie,)).start()
+        return "break"
+
+    def enrichSubmitted(self, movie):
+        """ Run the pending stages of the submitted movie on a worker thread
+        and tell the GUI when they are done.
+
+        """
+        statuses = enrichMovie(movie)
+        self.queue.put(MovieEnriched(movie, statuses))
+
+    def movieEnriched(self, statuses):
+        """ The stages of the submitted movie finished. Store it if they
+        all succeeded, otherwise tell the user which lookups failed.
 
+        """
+        failed = ["{0} lookup {1}".format(
+                      name.capitalize(),
+                      'timed out' if status == 'timeout' else 'failed')
+                  for name, status in sorted(statuses.items())
+                  if status in ('error', 'timeout')]
+        if failed:
+            self.insertStatusText(', '.join(failed) +
+                                  ". Submit again to retry.")
+            return
+        self.submitMovie()
+
+    def submitMovie(self):
+        """ Store the submitted movie (self.movie).
+
+        """
+        self.insertStatusText("")
         # Check if selected movie is already in DB. if not, then insert it
         # Else, open ReplaceMoviePopUp and ask user to replace it or not
-        if(alreadyExist(self.movieDict)):
+        if(alreadyExist(self.movie)):
             self.insertStatusText("Movie already in database")
             self.moviePopUp = ReplaceMoviePopUp(self, self.master)
         else:
-            insert2DB(self.movieDict)
-        return "break"
+            insert2DB(self.movie)
 
     def insertStatusText(self, text):
         """ Insert text in the bottom status bar to inform user.
@@ -209,6 +374,8 @@ class AddMovieGUI:
         self.statusTextBox.config(state=DISABLED)
 
     def _quit(self, event=None):
+        self.posterLoader.shutdown()
+        self.enrichPool.shutdown(wait=False)
         self.end_app()
         self.master.destroy()
         return "break"
@@ -227,28 +394,50 @@ class AddMovieGUI:
         In the original version, this instigates more events downstream.
 
         """
-        if self.movieListBox.size() == 0:
+        if not self.movieListBox.curselection():
             return
 
         # store the current selection in curMovie for subsequent processing
         self.curMovie = self.movieListBox.curselection()[0]
-        movieDict = self.movieList[self.curMovie]
-
-        # Take image URL and store image in imgData. Then set it in imgPanel
-        gotImage = False
-        if 'imageURL' in movieDict and movieDict['imageURL'] != "":
-            url = "http://ia.media-imdb.com/images/M/{0}._V1_"\
-                "SY150_CR3,0,101,150_AL_.jpg".format(movieDict['imageURL'])
-            resp = getContent(url)
-            if resp:
-                imgData = BytesIO(resp.read())
-                pil_image = Image.open(imgData)
-                img2 = ImageTk.PhotoImage(image=pil_image)
-                self.imgPanel.config(image=img2)
-                self.imgPanel.image = img2
-                gotImage = True
-
-        # If we couldn't load movie image, set default image instead
-        if not gotImage:
+        movie = self.movieList[self.curMovie]
+
+        # Start enriching the movie in case it gets submitted
+        if pendingStages(movie):
+            self.enrichPool.submit(enrichMovie, movie)
+
+        # Show the poster right away if it is in memory. Otherwise show the
+        # default image and let posterLoader fetch it in the background.
+        imageURL = movie.imageURL
+        image = None
+        if imageURL:
+            image = self.posterLoader.cache.getCached(imageURL)
+            if image is None:
+                self.posterLoader.request(imageURL)
+        if image is not None:
+            self.showPoster(image)
+        else:
             clearImg(self)
         return "break"
+
+    def posterLoaded(self, imageURL, image):
+        """ A poster finished loading. Show it if its movie is still the
+        selected one.
+
+        """
+        selection = self.movieListBox.curselection()
+        if not selection or selection[0] >= len(self.movieList):
+            return
+        if self.movieList[selection[0]].imageURL != imageURL:
+            return
+        if image is not None:
+            self.showPoster(image)
+        else:
+            clearImg(self)
+
+    def showPoster(self, pil_image):
+        """ Set the decoded poster as the image in imgPanel.
+
+        """
+        img2 = ImageTk.PhotoImage(image=pil_image)
+        self.imgPanel.config(image=img2)
+        self.imgPanel.image = img2
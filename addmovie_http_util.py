@@ -0,0 +1,558 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 *
+""" Shared HTTP client used for every web request.
+
+urllib.request opens a new TCP connection (and does a new TLS handshake) for
+each request. HTTPClient instead keeps a pool of persistent keep-alive
+connections for every host, caches DNS lookups, uses separate connect and
+read timeouts, and retries with exponential backoff when a server returns a
+5xx error or the connection fails. getContent in addmovie_web_util sends all
+its requests through the module level client.
+
+Every request also goes through the HostLimiter of its host, which allows
+at most maxConcurrent requests to the host at a time and paces them with a
+token bucket (rate requests per second, bursts of up to burst). When the
+host answers 429 or 503 the limiter halves its rate and pauses the host for
+the Retry-After time (or the backoff delay), and the rate climbs back to
+its configured value while requests succeed. Many threads scraping the same
+site then slow down together instead of getting the client blocked.
+
+Requests, retries, errors, throttling, latency and bytes are counted per
+host in the shared metrics of addmovie_metrics_util.
+
+"""
+
+
+import email.utils
+import random
+import socket
+import threading
+import time
+import http.client
+import urllib.parse
+
+from addmovie_metrics_util import metrics
+
+# Seconds to wait for a TCP connection to be established
+CONNECT_TIMEOUT = 5
+# Seconds to wait for data on an established connection
+READ_TIMEOUT = 10
+# Number of times a failed request is tried again
+MAX_RETRIES = 3
+# Delay before the first retry. It doubles after every failed attempt.
+BACKOFF_FACTOR = 0.5
+# Idle connections kept open per host
+MAX_IDLE_PER_HOST = 8
+# Seconds a resolved host address is reused
+DNS_TTL = 300
+MAX_REDIRECTS = 10
+USER_AGENT = "'Mozilla/5.0 (Windows NT 6.1; WOW64)"
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+# Responses that mean the host wants us to slow down
+THROTTLE_CODES = (429, 503)
+
+# Host -> (requests per second, burst, concurrent requests)
+HOST_LIMITS = {
+    'www.bing.com': (1.0, 3, 2),
+    'www.imdb.com': (5.0, 10, 8),
+}
+DEFAULT_HOST_LIMIT = (10.0, 20, 8)
+# The rate is never cut below this fraction of the configured rate
+MIN_RATE_FRACTION = 0.05
+# Fraction of the configured rate the rate grows by after a success
+RATE_RECOVERY = 0.05
+# Longest Retry-After we honour, in seconds
+MAX_RETRY_AFTER = 120
+
+
+def retryAfter(headers):
+    """ Return the seconds to wait asked for by the Retry-After header, or
+    None if there is none. The header is either a number of seconds or an
+    HTTP date.
+
+    """
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        delay = int(value)
+    else:
+        try:
+            delay = (email.utils.parsedate_to_datetime(value).timestamp() -
+                     time.time())
+        except (TypeError, ValueError):
+            return None
+    return min(max(0.0, delay), MAX_RETRY_AFTER)
+
+
+class HostLimiter:
+    """ Token bucket and concurrency cap for the requests to one host.
+
+    Parameters
+    ----------
+    rate : float
+        requests per second when the host doesn't throttle us
+    burst : int
+        number of requests that may be sent at once after a quiet period
+    maxConcurrent : int
+        number of requests to the host in flight at the same time
+
+    """
+
+    def __init__(self, rate, burst, maxConcurrent):
+        self.maxRate = rate
+        self.rate = rate
+        self.burst = burst
+        self.maxConcurrent = maxConcurrent
+        self.active = 0
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._pausedUntil = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """ Wait until a request may be sent to the host.
+
+        """
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._updated) * self.rate)
+                self._updated = now
+                if self.active >= self.maxConcurrent:
+                    wait = None
+                elif now < self._pausedUntil:
+                    wait = self._pausedUntil - now
+                elif self._tokens < 1:
+                    wait = (1 - self._tokens) / self.rate
+                else:
+                    self._tokens -= 1
+                    self.active += 1
+                    return
+                self._cond.wait(wait)
+
+    def release(self):
+        """ A request acquired before is finished.
+
+        """
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    def succeeded(self):
+        with self._cond:
+            if self.rate < self.maxRate:
+                self.rate = min(self.maxRate,
+                                self.rate + self.maxRate * RATE_RECOVERY)
+
+    def throttled(self, delay):
+        """ The host asked us to slow down. Halve the rate and don't send
+        anything for delay seconds.
+
+        """
+        with self._cond:
+            self.rate = max(self.maxRate * MIN_RATE_FRACTION, self.rate / 2)
+            self._tokens = min(self._tokens, 0.0)
+            self._pausedUntil = max(self._pausedUntil,
+                                    time.monotonic() + delay)
+            self._cond.notify_all()
+
+
+class DNSCache:
+    """ Thread safe cache of getaddrinfo results so the same host is only
+    resolved once every DNS_TTL seconds.
+
+    """
+
+    def __init__(self, ttl=DNS_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """ Return the list of (family, type, proto, sockaddr) for host.
+
+        """
+        key = (host, port)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                return entry[1]
+        infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        addrs = [(family, socktype, proto, sockaddr)
+                 for family, socktype, proto, _, sockaddr in infos]
+        with self._lock:
+            self._entries[key] = (now + self.ttl, addrs)
+        return addrs
+
+    def forget(self, host, port):
+        with self._lock:
+            self._entries.pop((host, port), None)
+
+    def connect(self, address, timeout, source_address=None):
+        """ Drop-in replacement for socket.create_connection that uses the
+        cached addresses.
+
+        """
+        host, port = address
+        err = None
+        for family, socktype, proto, sockaddr in self.resolve(host, port):
+            sock = None
+            try:
+                sock = socket.socket(family, socktype, proto)
+                sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect(sockaddr)
+                return sock
+            except OSError as e:
+                err = e
+                if sock is not None:
+                    sock.close()
+        # None of the cached addresses worked. Resolve again next time.
+        self.forget(host, port)
+        if err is not None:
+            raise err
+        raise OSError("getaddrinfo returned no addresses for " + host)
+
+
+class _PooledConnectionMixin:
+    """ Connects through the DNS cache and switches from the connect timeout
+    to the read timeout once the socket is open.
+
+    """
+
+    def setup(self, dnsCache, readTimeout):
+        self._create_connection = dnsCache.connect
+        self.readTimeout = readTimeout
+
+    def connect(self):
+        super().connect()
+        self.sock.settimeout(self.readTimeout)
+
+
+class PooledHTTPConnection(_PooledConnectionMixin,
+                           http.client.HTTPConnection):
+    pass
+
+
+class PooledHTTPSConnection(_PooledConnectionMixin,
+                            http.client.HTTPSConnection):
+    pass
+
+
+class PooledResponse:
+    """ Response returned by HTTPClient.request. It has the same interface
+    as the object returned by urlopen (read, geturl, getcode, info) and gives
+    its connection back to the pool once the body has been read. The slot
+    of the host's HostLimiter is held until then as well.
+
+    """
+
+    def __init__(self, client, key, conn, resp, url, limiter=None):
+        self._client = client
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+        self._limiter = limiter
+        self.url = url
+        self.status = resp.status
+        self.reason = resp.reason
+        self.headers = resp.headers
+        self._bytesRead = 0
+
+    def read(self, amt=None):
+        try:
+            data = self._resp.read(amt)
+        except BaseException:
+            self._discard()
+            raise
+        self._bytesRead += len(data)
+        if self._resp.isclosed():
+            self._release()
+        return data
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.status
+
+    def info(self):
+        return self.headers
+
+    def close(self):
+        """ Close the response. A connection whose body was not read to the
+        end can't be reused, so it is closed as well.
+
+        """
+        if self._resp.isclosed():
+            self._release()
+        else:
+            self._discard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        # A response that was dropped without being closed must not keep
+        # its connection and limiter slot forever
+        if self._conn is not None or self._limiter is not None:
+            self._discard()
+
+    def _release(self):
+        if self._conn is not None:
+            metrics.observe('http_response_bytes', self._bytesRead,
+                            host=self._key[1])
+            if self._resp.will_close:
+                self._conn.close()
+            else:
+                self._client._putConnection(self._key, self._conn)
+            self._conn = None
+        self._releaseLimiter()
+
+    def _discard(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+            self._resp.close()
+        self._releaseLimiter()
+
+    def _releaseLimiter(self):
+        if self._bytesRead:
+            metrics.inc('http_response_bytes_total', self._bytesRead,
+                        host=self._key[1])
+            self._bytesRead = 0
+        if self._limiter is not None:
+            self._limiter.release()
+            self._limiter = None
+
+
+class HTTPClient:
+    """ HTTP/1.1 client with per host keep-alive connection pools.
+
+    Parameters
+    ----------
+    connectTimeout : float
+        seconds to wait for a connection to be established
+    readTimeout : float
+        seconds to wait for data from the server
+    maxRetries : int
+        number of times a request is retried on connection errors and
+        5xx responses
+    backoffFactor : float
+        delay before the first retry, doubled after every attempt
+    maxIdlePerHost : int
+        number of idle connections kept open for every host
+    hostLimits : dictionary
+        (rate, burst, maxConcurrent) of the HostLimiter, per host name
+    defaultHostLimit : tuple
+        (rate, burst, maxConcurrent) for hosts not in hostLimits
+
+    """
+
+    def __init__(self, connectTimeout=CONNECT_TIMEOUT,
+                 readTimeout=READ_TIMEOUT, maxRetries=MAX_RETRIES,
+                 backoffFactor=BACKOFF_FACTOR,
+                 maxIdlePerHost=MAX_IDLE_PER_HOST, hostLimits=HOST_LIMITS,
+                 defaultHostLimit=DEFAULT_HOST_LIMIT):
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        self.maxRetries = maxRetries
+        self.backoffFactor = backoffFactor
+        self.maxIdlePerHost = maxIdlePerHost
+        self.hostLimits = dict(hostLimits)
+        self.defaultHostLimit = defaultHostLimit
+        self.dnsCache = DNSCache()
+        self._pools = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def setHostLimit(self, host, rate, burst, maxConcurrent):
+        """ Change the rate, burst and concurrency allowed for host.
+
+        """
+        with self._lock:
+            self.hostLimits[host] = (rate, burst, maxConcurrent)
+            self._limiters.pop(host, None)
+
+    def limiterFor(self, host):
+        with self._lock:
+            limiter = self._limiters.get(host)
+            if limiter is None:
+                limiter = self._limiters[host] = HostLimiter(
+                    *self.hostLimits.get(host, self.defaultHostLimit))
+            return limiter
+
+    def request(self, url, method='GET', headers=None, timeout=None,
+                followRedirects=True):
+        """ Send a request and return a PooledResponse. Redirects are
+        followed unless followRedirects is False. 5xx responses and
+        connection errors are retried with exponential backoff. Once the
+        retries run out the last response (or exception) is returned
+        (raised) to the caller.
+
+        Parameters
+        ----------
+        url : string
+        method : string
+        headers : dictionary
+            extra request headers
+        timeout : float
+            read timeout for this request, overrides readTimeout
+
+        Returns
+        -------
+        resp : PooledResponse
+
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            resp = self._requestWithRetries(url, method, headers, timeout)
+            location = resp.headers.get('Location')
+            if (not followRedirects or resp.status not in REDIRECT_CODES or
+                    not location):
+                return resp
+            # Read the (small) redirect body so the connection can be reused
+            resp.read()
+            resp.close()
+            url = urllib.parse.urljoin(url, location)
+            if resp.status == 303:
+                method = 'GET'
+        raise http.client.HTTPException("Too many redirects: " + url)
+
+    def _requestWithRetries(self, url, method, headers, timeout):
+        host = urllib.parse.urlsplit(url).hostname
+        limiter = self.limiterFor(host)
+        attempt = 0
+        while True:
+            delay = self.backoffFactor * (2 ** attempt)
+            delay += random.uniform(0, delay / 2)
+            start = time.perf_counter()
+            limiter.acquire()
+            sent = time.perf_counter()
+            metrics.observe('http_limiter_wait_seconds', sent - start,
+                            host=host)
+            try:
+                resp = self._send(url, method, headers, timeout, limiter)
+            except BaseException as e:
+                limiter.release()
+                metrics.inc('http_errors_total', host=host,
+                            error=type(e).__name__)
+                # Sending a bad url again won't help
+                if (not isinstance(e, (OSError, http.client.HTTPException))
+                        or isinstance(e, http.client.InvalidURL)
+                        or attempt >= self.maxRetries):
+                    raise
+            else:
+                metrics.observe('http_request_seconds',
+                                time.perf_counter() - sent, host=host)
+                metrics.inc('http_requests_total', host=host,
+                            status=resp.status)
+                if resp.status in THROTTLE_CODES:
+                    metrics.inc('http_throttled_total', host=host)
+                    wait = retryAfter(resp.headers)
+                    limiter.throttled(delay if wait is None else wait)
+                elif resp.status < 500:
+                    limiter.succeeded()
+                if ((resp.status < 500 and resp.status != 429) or
+                        attempt >= self.maxRetries):
+                    return resp
+                resp.close()
+                if resp.status in THROTTLE_CODES:
+                    # limiter.acquire waits as long as the host asked
+                    metrics.inc('http_retries_total', host=host)
+                    attempt += 1
+                    continue
+            metrics.inc('http_retries_total', host=host)
+            time.sleep(delay)
+            attempt += 1
+
+    def _send(self, url, method, headers, timeout, limiter=None):
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ('http', 'https'):
+            raise http.client.InvalidURL("Unsupported URL scheme: " + url)
+        try:
+            port = parts.port or (443 if scheme == 'https' else 80)
+        except ValueError:
+            raise http.client.InvalidURL("Invalid port: " + url)
+        if not parts.hostname:
+            raise http.client.InvalidURL("No host in URL: " + url)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        reqHeaders = {'User-Agent': USER_AGENT, 'Accept-Encoding': 'identity'}
+        if headers:
+            reqHeaders.update(headers)
+
+        conn, reused = self._getConnection(key, timeout)
+        try:
+            conn.request(method, path, headers=reqHeaders)
+            resp = conn.getresponse()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            if not reused:
+                raise
+            # The server closed the idle keep-alive connection. Try once on a
+            # fresh connection without counting it as a retry.
+            conn = self._newConnection(key, timeout)
+            try:
+                conn.request(method, path, headers=reqHeaders)
+                resp = conn.getresponse()
+            except BaseException:
+                conn.close()
+                raise
+        return PooledResponse(self, key, conn, resp, url, limiter)
+
+    def _getConnection(self, key, timeout):
+        with self._lock:
+            idle = self._pools.get(key)
+            conn = idle.pop() if idle else None
+        if conn is not None:
+            readTimeout = timeout or self.readTimeout
+            conn.readTimeout = readTimeout
+            if conn.sock is not None:
+                conn.sock.settimeout(readTimeout)
+            return conn, True
+        return self._newConnection(key, timeout), False
+
+    def _newConnection(self, key, timeout):
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = PooledHTTPSConnection(host, port,
+                                         timeout=self.connectTimeout)
+        else:
+            conn = PooledHTTPConnection(host, port,
+                                        timeout=self.connectTimeout)
+        conn.setup(self.dnsCache, timeout or self.readTimeout)
+        return conn
+
+    def _putConnection(self, key, conn):
+        with self._lock:
+            idle = self._pools.setdefault(key, [])
+            if len(idle) < self.maxIdlePerHost:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """ Close all idle connections.
+
+        """
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for idle in pools.values():
+            for conn in idle:
+                conn.close()
+
+
+# The client shared by the whole application
+client = HTTPClient()
@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 *
+""" Offline title search on a local copy of the IMDb title.basics dataset.
+
+buildIndex turns title.basics.tsv(.gz) (and optionally title.ratings.tsv.gz,
+to rank popular titles first) from https://datasets.imdbws.com into a
+single index file. TitleIndex memory-maps that file and searches it without
+loading it, so opening the index is instant and its pages are shared by
+every process that uses it.
+
+The index stores the normalized titles (see normalizeQuery) sorted, in
+columns of fixed-size numbers next to one blob with the title text, and an
+inverted index from the hash of every trigram of a title to the titles that
+contain it. A search looks up the titles that start with the query with a
+binary search, and the titles that share the query's rarest trigrams in the
+inverted index. The candidates are ranked by trigram similarity to the
+query, exact and prefix matches, the year if the query ends with one, and
+the number of votes.
+
+    python addmovie_index_util.py title.basics.tsv.gz \
+        --ratings title.ratings.tsv.gz
+
+If the index file exists (TITLE_INDEX_PATH), imdbSearch in
+addmovie_web_util uses it instead of Bing.
+
+"""
+
+
+import argparse
+import bisect
+import gzip
+import json
+import math
+import mmap
+import os
+import re
+import sys
+import threading
+import unicodedata
+import zlib
+from array import array
+from collections import Counter
+
+TITLE_INDEX_PATH = os.environ.get(
+    'MINISCRAPE_TITLE_INDEX',
+    os.path.join(os.path.expanduser('~'), '.miniscrape', 'titles.idx'))
+# title.basics titleTypes that are indexed unless others are asked for
+DEFAULT_TITLE_TYPES = ('movie', 'tvMovie', 'tvSeries', 'tvMiniSeries',
+                       'tvSpecial', 'video')
+# Number of imdb IDs returned by a search, as many as Bing returns
+NUM_RESULTS = 5
+# Largest number of postings read from the inverted index per search. The
+# rarest trigrams of the query are read first.
+MAX_POSTINGS = 4000
+# Number of candidates scored by similarity per search
+MAX_CANDIDATES = 200
+# Number of titles starting with the query that are scored per search
+MAX_PREFIX_MATCHES = 50
+# Trigram similarity (Jaccard) a title needs to match a query, unless it is
+# the query or starts with it. With no such title the search returns
+# nothing, so imdbSearch asks Bing.
+MIN_SIMILARITY = 0.5
+
+INDEX_MAGIC = b'MSTITLE1'
+# Columns of the index file and the array typecodes they are stored in
+_sections = (('ids', 'I'), ('votes', 'I'), ('years', 'H'), ('kinds', 'B'),
+             ('titleOffsets', 'I'), ('titles', 'B'), ('trigrams', 'I'),
+             ('postingOffsets', 'I'), ('postings', 'I'))
+
+apostrophePat = re.compile(r"['\u2018\u2019`]")
+queryPunctuationPat = re.compile(r"[\W_]+")
+queryYearPat = re.compile(r"^(.*\S)\s+((?:18|19|20)\d\d)$")
+
+
+def normalizeQuery(query):
+    """ Return query in the form used to search and to cache the results:
+    lower case, without apostrophes, with every other run of punctuation
+    and whitespace replaced by a single space. Queries that only differ in
+    those still find the same movies.
+
+    """
+    query = unicodedata.normalize('NFKC', query).casefold()
+    query = apostrophePat.sub('', query)
+    return queryPunctuationPat.sub(' ', query).strip()
+
+
+def trigrams(title):
+    """ Return the set of trigrams of a normalized title. The title is
+    padded with spaces, so the start and end of words count too.
+
+    """
+    padded = ' ' + title + ' '
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def trigramHash(trigram):
+    return zlib.crc32(trigram.encode('utf-8'))
+
+
+def _openTSV(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='\n')
+    return open(path, encoding='utf-8', newline='\n')
+
+
+def readRatings(path):
+    """ Return a dictionary from numeric imdb ID to numVotes read from a
+    title.ratings TSV file.
+
+    """
+    votes = {}
+    with _openTSV(path) as f:
+        header = f.readline().rstrip('\n').split('\t')
+        idCol, votesCol = header.index('tconst'), header.index('numVotes')
+        for line in f:
+            row = line.rstrip('\n').split('\t')
+            votes[int(row[idCol][2:])] = int(row[votesCol])
+    return votes
+
+
+def readTitles(path, titleTypes=DEFAULT_TITLE_TYPES):
+    """ Yield (normalized title, numeric imdb ID, year, titleType) for every
+    title of titleTypes in a title.basics TSV file. A title whose original
+    title differs from its primary title is yielded under both.
+
+    """
+    titleTypes = set(titleTypes)
+    with _openTSV(path) as f:
+        header = f.readline().rstrip('\n').split('\t')
+        cols = dict((name, i) for i, name in enumerate(header))
+        for line in f:
+            row = line.rstrip('\n').split('\t')
+            kind = row[cols['titleType']]
+            if kind not in titleTypes or row[cols['isAdult']] == '1':
+                continue
+            imdbID = int(row[cols['tconst']][2:])
+            year = row[cols['startYear']]
+            year = int(year) if year.isdigit() else 0
+            names = set()
+            for col in ('primaryTitle', 'originalTitle'):
+                name = normalizeQuery(row[cols[col]])
+                if name and name not in names:
+                    names.add(name)
+                    yield name, imdbID, year, kind
+
+
+def buildIndex(basicsPath, indexPath=TITLE_INDEX_PATH, ratingsPath=None,
+               titleTypes=DEFAULT_TITLE_TYPES):
+    """ Build the index file at indexPath from a title.basics TSV file.
+
+    Parameters
+    ----------
+    basicsPath : string
+        title.basics.tsv or title.basics.tsv.gz
+    indexPath : string
+        where the index is written
+    ratingsPath : string
+        title.ratings.tsv(.gz). Titles with more votes are ranked first.
+    titleTypes : list
+        the titleTypes that are indexed
+
+    Returns
+    -------
+    numTitles : int
+        number of titles in the index
+
+    """
+    votesOf = readRatings(ratingsPath) if ratingsPath else {}
+    rows = sorted(readTitles(basicsPath, titleTypes),
+                  key=lambda row: row[0].encode('utf-8'))
+    kindNames = sorted(set(row[3] for row in rows))
+    kindIndex = dict((kind, i) for i, kind in enumerate(kindNames))
+
+    columns = dict((name, array(code)) for name, code in _sections)
+    titleBlob = bytearray()
+    columns['titleOffsets'].append(0)
+    postingLists = {}
+    for i, (title, imdbID, year, kind) in enumerate(rows):
+        columns['ids'].append(imdbID)
+        columns['votes'].append(votesOf.get(imdbID, 0))
+        columns['years'].append(year)
+        columns['kinds'].append(kindIndex[kind])
+        titleBlob += title.encode('utf-8')
+        columns['titleOffsets'].append(len(titleBlob))
+        for h in set(trigramHash(t) for t in trigrams(title)):
+            postings = postingLists.get(h)
+            if postings is None:
+                postings = postingLists[h] = array('I')
+            postings.append(i)
+    columns['titles'] = array('B', titleBlob)
+    columns['postingOffsets'].append(0)
+    for h in sorted(postingLists):
+        columns['trigrams'].append(h)
+        columns['postings'].extend(postingLists[h])
+        columns['postingOffsets'].append(len(columns['postings']))
+    del postingLists
+
+    # Every column starts at a multiple of 8 bytes, so it can be cast to
+    # its typecode straight from the memory map
+    layout = {}
+    offset = 0
+    for name, code in _sections:
+        nbytes = len(columns[name]) * columns[name].itemsize
+        layout[name] = [offset, nbytes, code]
+        offset += (nbytes + 7) // 8 * 8
+    header = json.dumps({'kinds': kindNames, 'sections': layout,
+                         'byteorder': sys.byteorder}).encode('utf-8')
+    dataStart = (len(INDEX_MAGIC) + 4 + len(header) + 7) // 8 * 8
+
+    directory = os.path.dirname(indexPath)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = '{0}.{1}.tmp'.format(indexPath, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(INDEX_MAGIC)
+        f.write(len(header).to_bytes(4, 'little'))
+        f.write(header)
+        for name, code in _sections:
+            f.write(bytes(dataStart + layout[name][0] - f.tell()))
+            columns[name].tofile(f)
+    os.replace(tmp, indexPath)
+    return len(rows)
+
+
+class TitleIndex:
+    """ Memory-mapped title index written by buildIndex.
+
+    Parameters
+    ----------
+    path : string
+        the index file
+
+    """
+
+    def __init__(self, path=TITLE_INDEX_PATH):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            self._map.close()
+            raise ValueError("{0} is not a title index".format(path))
+        pos = len(INDEX_MAGIC)
+        headerLength = int.from_bytes(self._map[pos:pos + 4], 'little')
+        header = json.loads(self._map[pos + 4:pos + 4 + headerLength]
+                            .decode('utf-8'))
+        if header['byteorder'] != sys.byteorder:
+            self._map.close()
+            raise ValueError("{0} was built on a machine with a different "
+                             "byte order".format(path))
+        dataStart = (pos + 4 + headerLength + 7) // 8 * 8
+        self.kinds = header['kinds']
+        self._view = memoryview(self._map)
+        for name, (offset, nbytes, code) in header['sections'].items():
+            start = dataStart + offset
+            setattr(self, name,
+                    self._view[start:start + nbytes].cast(code))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def close(self):
+        for name, code in _sections:
+            getattr(self, name).release()
+        self._view.release()
+        self._map.close()
+
+    def title(self, i):
+        """ Return the normalized title of entry i.
+
+        """
+        return bytes(self.titles[self.titleOffsets[i]:
+                                 self.titleOffsets[i + 1]]).decode('utf-8')
+
+    def prefixMatches(self, prefix, limit=MAX_PREFIX_MATCHES):
+        """ Return the entries whose title starts with prefix, at most
+        limit of them.
+
+        """
+        key = prefix.encode('utf-8')
+        lo, hi = 0, len(self.ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.titleOffsets[mid]
+            if bytes(self.titles[start:self.titleOffsets[mid + 1]]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        matches = []
+        while lo < len(self.ids) and len(matches) < limit:
+            start = self.titleOffsets[lo]
+            if bytes(self.titles[start:start + len(key)]) != key:
+                break
+            matches.append(lo)
+            lo += 1
+        return matches
+
+    def trigramPostings(self, trigram):
+        """ Return the entries whose title contains trigram (or another
+        trigram with the same hash).
+
+        """
+        h = trigramHash(trigram)
+        i = bisect.bisect_left(self.trigrams, h)
+        if i == len(self.trigrams) or self.trigrams[i] != h:
+            return self.postings[0:0]
+        return self.postings[self.postingOffsets[i]:
+                             self.postingOffsets[i + 1]]
+
+    def search(self, query, limit=NUM_RESULTS):
+        """ Return the imdb IDs (without the 'tt' prefix) of the titles
+        that match query best, best first. Titles that are not the query,
+        don't start with it and are no more than MIN_SIMILARITY similar to
+        it don't match, so a query with no match returns an empty list.
+
+        """
+        title = normalizeQuery(query)
+        if not title or not len(self.ids):
+            return []
+        # A year at the end may be the release year or part of the title
+        titles = [title]
+        year = 0
+        m = queryYearPat.match(title)
+        if m:
+            titles.append(m.group(1))
+            year = int(m.group(2))
+        queryTrigrams = trigrams(title)
+
+        # Titles starting with the query, then the ones sharing the most
+        # of its rarest trigrams
+        candidates = set()
+        for prefix in titles:
+            candidates.update(self.prefixMatches(prefix))
+        lists = sorted((self.trigramPostings(t) for t in queryTrigrams),
+                       key=len)
+        hits = Counter()
+        read = 0
+        for postings in lists:
+            if read and read + len(postings) > MAX_POSTINGS:
+                break
+            hits.update(postings)
+            read += len(postings)
+        if hits:
+            # Only titles sharing at least half as many trigrams as the best
+            # one are worth scoring
+            minHits = (max(hits.values()) + 1) // 2
+            close = [(n, i) for i, n in hits.items() if n >= minHits]
+            if len(close) > MAX_CANDIDATES:
+                close.sort(reverse=True)
+                del close[MAX_CANDIDATES:]
+            candidates.update(i for _, i in close)
+
+        scored = []
+        for i in candidates:
+            candidate = self.title(i)
+            other = trigrams(candidate)
+            score = (len(queryTrigrams & other) /
+                     len(queryTrigrams | other))
+            if candidate in titles:
+                score += 1.0
+            elif candidate.startswith(titles[-1]):
+                score += 0.3
+            elif score <= MIN_SIMILARITY:
+                continue
+            if year and self.years[i] == year:
+                score += 0.5
+            score += 0.05 * math.log10(self.votes[i] + 1)
+            scored.append((score, i))
+
+        imdbIDs = []
+        for score, i in sorted(scored, reverse=True):
+            imdbID = '{0:07d}'.format(self.ids[i])
+            if imdbID not in imdbIDs:
+                imdbIDs.append(imdbID)
+                if len(imdbIDs) == limit:
+                    break
+        return imdbIDs
+
+
+_titleIndex = None
+_titleIndexLock = threading.Lock()
+
+
+def getTitleIndex(path=None):
+    """ Return the TitleIndex shared by the application, or None if there
+    is no index file. It is opened on first use. A path opens that index
+    instead of the one at TITLE_INDEX_PATH.
+
+    """
+    global _titleIndex
+    with _titleIndexLock:
+        if path is not None and (_titleIndex is None or
+                                 _titleIndex.path != path):
+            _titleIndex = TitleIndex(path)
+        elif _titleIndex is None and os.path.exists(TITLE_INDEX_PATH):
+            try:
+                _titleIndex = TitleIndex(TITLE_INDEX_PATH)
+            except (OSError, ValueError) as e:
+                print("Could not open title index {0}, {1}"
+                      .format(TITLE_INDEX_PATH, e))
+        return _titleIndex
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Build the offline title index from the IMDb "
+                    "title.basics dataset.")
+    parser.add_argument('basics', help="title.basics.tsv(.gz)")
+    parser.add_argument('--ratings', default=None,
+                        help="title.ratings.tsv(.gz), to rank titles with "
+                             "more votes first")
+    parser.add_argument('-o', '--output', default=TITLE_INDEX_PATH,
+                        help="where the index is written (default: "
+                             "{0})".format(TITLE_INDEX_PATH))
+    parser.add_argument('--types', default=','.join(DEFAULT_TITLE_TYPES),
+                        help="comma separated titleTypes to index")
+    args = parser.parse_args(argv)
+    numTitles = buildIndex(args.basics, args.output, args.ratings,
+                           args.types.split(','))
+    print("{0} titles written to {1}".format(numTitles, args.output))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 *
+""" Journal of a batch job, so an interrupted job can be resumed.
+
+batch.py --journal appends one JSON line per finished input line to the
+journal: the input, whether it failed, how many times it was tried and the
+records written for it. The file is fsynced every SYNC_EVERY entries or
+SYNC_INTERVAL seconds, so a crash loses at most that much work. When the
+job is started again with the same journal, the lines that are done are
+skipped, and failed lines are tried again until they have failed
+MAX_ATTEMPTS times. Reading the journal back only takes a pass over the
+file, instead of scraping everything again.
+
+The output of the job is written from the journal once the job finishes,
+to a temporary file that is renamed over the output, so the output file
+is either the previous one or complete.
+
+"""
+
+
+import json
+import os
+import threading
+import time
+
+# Entries written between two fsyncs of the journal
+SYNC_EVERY = 100
+# Seconds after which written entries are fsynced anyway
+SYNC_INTERVAL = 1.0
+# Times a failing line is tried, over all runs of the job
+MAX_ATTEMPTS = 3
+
+
+def fsyncDirectory(path):
+    """ Make a rename in the directory of path durable. Not every platform
+    can open directories, in which case this does nothing.
+
+    """
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class JobJournal:
+    """ Append-only journal of the finished lines of a batch job.
+
+    Parameters
+    ----------
+    path : string
+        the journal file. It is created if it doesn't exist and read back
+        if it does.
+    maxAttempts : int
+        times a failing line is tried before it is given up on
+    syncEvery : int
+        entries written between two fsyncs
+    syncInterval : float
+        seconds after which written entries are fsynced anyway
+
+    """
+
+    def __init__(self, path, maxAttempts=MAX_ATTEMPTS, syncEvery=SYNC_EVERY,
+                 syncInterval=SYNC_INTERVAL):
+        self.path = path
+        self.maxAttempts = maxAttempts
+        self.syncEvery = syncEvery
+        self.syncInterval = syncInterval
+        self._lock = threading.Lock()
+        # input line -> (offset, failed, attempts) of its latest entry
+        self._entries = {}
+        self._size = 0
+        self._unsynced = 0
+        self._lastSync = time.monotonic()
+        self._load()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'ab')
+        if self._size != self._file.tell():
+            # Drop the half written entry of a crash, or the next entry
+            # would be appended to it
+            self._file.truncate(self._size)
+            self._file.seek(self._size)
+
+    def _load(self):
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+        offset = 0
+        with f:
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError("entry cut short")
+                    entry = json.loads(line.decode('utf-8'))
+                    self._entries[entry['input']] = (
+                        offset, entry['failed'], entry['attempts'])
+                except (ValueError, KeyError, TypeError):
+                    # Everything after a broken entry was written after a
+                    # crash, so the journal ends here
+                    break
+                offset += len(line)
+        self._size = offset
+
+    def counts(self):
+        """ Return the number of lines that are done, and the number that
+        failed and are given up on.
+
+        """
+        with self._lock:
+            done = sum(1 for offset, failed, attempts
+                       in self._entries.values() if not failed)
+            givenUp = sum(1 for offset, failed, attempts
+                          in self._entries.values()
+                          if failed and attempts >= self.maxAttempts)
+        return done, givenUp
+
+    def shouldRun(self, line):
+        """ True if line has not been done, and has failed fewer than
+        maxAttempts times.
+
+        """
+        with self._lock:
+            entry = self._entries.get(line)
+        if entry is None:
+            return True
+        offset, failed, attempts = entry
+        return failed and attempts < self.maxAttempts
+
+    def append(self, line, records, failed):
+        """ Record that line finished.
+
+        Parameters
+        ----------
+        line : string
+            the input line
+        records : list
+            the dictionaries written to the output for line
+        failed : bool
+            line should be tried again in the next run
+
+        """
+        with self._lock:
+            previous = self._entries.get(line)
+            attempts = previous[2] + 1 if previous is not None else 1
+            data = (json.dumps({'input': line, 'failed': failed,
+                                'attempts': attempts, 'records': records}) +
+                    '\n').encode('utf-8')
+            self._file.write(data)
+            self._entries[line] = (self._size, failed, attempts)
+            self._size += len(data)
+            self._unsynced += 1
+            if (self._unsynced >= self.syncEvery or
+                    time.monotonic() - self._lastSync >= self.syncInterval):
+                self._sync()
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        if self._file.closed:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._lastSync = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def writeOutput(self, path):
+        """ Write the records of the latest entry of every line to path as
+        JSON lines, in the order those entries were written. The file is
+        written next to path and renamed over it once it is complete.
+
+        Returns
+        -------
+        numRecords : int
+
+        """
+        self.sync()
+        with self._lock:
+            latest = set(offset for offset, failed, attempts
+                         in self._entries.values())
+            size = self._size
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        numRecords = 0
+        try:
+            with open(self.path, 'rb') as journal, \
+                    open(tmp, 'w', encoding='utf-8') as out:
+                offset = 0
+                for line in journal:
+                    if offset >= size:
+                        break
+                    if offset in latest:
+                        entry = json.loads(line.decode('utf-8'))
+                        for record in entry['records']:
+                            out.write(json.dumps(record) + '\n')
+                            numRecords += 1
+                    offset += len(line)
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        fsyncDirectory(path)
+        return numRecords
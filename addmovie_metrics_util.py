@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 *
+""" Timing and counters for the stages of a search.
+
+Every stage of the scraper runs inside a metrics.span: the Bing search, the
+title index lookup, the IMDB page download, parsing it, the amazon redirect
+and the poster fetch. A span records how long the stage took in the
+stage_seconds histogram and counts the exceptions that escape it in
+stage_errors_total. The HTTP client counts requests, retries, throttling,
+errors, latency and bytes per host, and the caches count their hits and
+misses, so a slow search can be taken apart without adding prints.
+
+The numbers are read with metrics.snapshot() (a dictionary that can be
+dumped as JSON) or metrics.toPrometheus() (the Prometheus text format).
+They are written to the file in MINISCRAPE_METRICS when the program exits,
+as Prometheus text if the name ends in .prom and as JSON otherwise. Set
+MINISCRAPE_TRACE to print every finished span, with its duration, and
+MINISCRAPE_PROFILE_DIR to write a cProfile file for every search (see
+profiled).
+
+"""
+
+
+import atexit
+import bisect
+import cProfile
+import itertools
+import json
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_PATH = os.environ.get('MINISCRAPE_METRICS')
+TRACE = bool(os.environ.get('MINISCRAPE_TRACE'))
+PROFILE_DIR = os.environ.get('MINISCRAPE_PROFILE_DIR')
+# Prefix of the metric names in the Prometheus output
+NAMESPACE = 'miniscrape'
+# Upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the buckets of histograms whose name ends in _bytes
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+METRIC_HELP = {
+    'stage_seconds': "Time spent in each stage of a search",
+    'stage_errors_total': "Exceptions raised in each stage",
+    'stage_timeouts_total': "Enrichment stages given up on after timeout",
+    'http_requests_total': "HTTP responses received, by host and status",
+    'http_request_seconds': "Time until the response headers arrived",
+    'http_limiter_wait_seconds': "Time spent waiting for the host limiter",
+    'http_response_bytes': "Size of the response bodies read to the end",
+    'http_response_bytes_total': "Bytes of response bodies read",
+    'http_errors_total': "Requests that failed without a response",
+    'http_retries_total': "Requests sent again after a failure",
+    'http_throttled_total': "429 and 503 responses",
+    'cache_hits_total': "Responses answered from the response cache",
+    'cache_misses_total': "Responses not in the response cache",
+    'query_cache_hits_total': "Searches answered by the query cache",
+    'query_cache_misses_total': "Searches not in the query cache",
+    'index_hits_total': "Searches answered by the offline title index",
+    'index_misses_total': "Searches the title index had no match for",
+    'poster_cache_hits_total': "Posters found in memory or on disk",
+    'poster_cache_misses_total': "Posters that had to be downloaded",
+}
+
+_labelEscapePat = re.compile(r'[\\"\n]')
+
+
+class Histogram:
+    """ Count, sum, maximum and bucket counts of observed values.
+
+    """
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # counts[i] is the number of values <= bounds[i] and > bounds[i-1].
+        # The last one counts the values above every bound.
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, fraction):
+        """ Estimate a quantile as the upper bound of the bucket it falls
+        in. Values above the last bound are estimated by the maximum.
+
+        """
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def toDict(self):
+        return {'count': self.count, 'sum': self.sum,
+                'mean': self.sum / self.count if self.count else 0.0,
+                'max': self.max, 'p50': self.quantile(0.5),
+                'p95': self.quantile(0.95),
+                'buckets': dict(zip([str(b) for b in self.bounds] + ['+Inf'],
+                                    self.counts))}
+
+
+class Metrics:
+    """ Thread safe registry of counters and histograms. A metric is
+    identified by its name and its labels, given as keyword arguments.
+    Label values are stored as strings. Keep them to a small set (hosts,
+    stages, status codes), since every combination is kept forever.
+
+    Parameters
+    ----------
+    trace : bool
+        print every finished span
+    profileDir : string
+        directory profiled writes its files to. None turns profiling off.
+
+    """
+
+    def __init__(self, trace=TRACE, profileDir=PROFILE_DIR):
+        self.trace = trace
+        self.profileDir = profileDir
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profileNumbers = itertools.count(1)
+
+    def inc(self, name, amount=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                bounds = (SIZE_BUCKETS if name.endswith('_bytes')
+                          else LATENCY_BUCKETS)
+                histogram = self._histograms[key] = Histogram(bounds)
+            histogram.observe(value)
+
+    @contextmanager
+    def span(self, stage, detail=None):
+        """ Time the block as stage. Exceptions that escape the block are
+        counted in stage_errors_total and raised again.
+
+        Parameters
+        ----------
+        stage : string
+            name of the stage, the stage label of the metrics
+        detail : string
+            shown in the trace output only, e.g. the url
+
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc('stage_errors_total', stage=stage)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe('stage_seconds', elapsed, stage=stage)
+            if self.trace:
+                # One write, so lines of different threads don't mix
+                sys.stdout.write("[trace] {0} {1:.1f}ms{2}\n".format(
+                    stage, elapsed * 1000, ' ' + detail if detail else ''))
+
+    def profiling(self):
+        """ True on a thread that is inside profiled.
+
+        """
+        return getattr(self._local, 'profile', None) is not None
+
+    @contextmanager
+    def profiled(self, name):
+        """ Run the block under cProfile and write the stats to
+        profileDir/<name>-<time>-<n>.prof, if profileDir is set. cProfile only
+        sees the calling thread, so code that would hand work to other
+        threads checks profiling() and does it in place instead. Read the
+        file with pstats or snakeviz.
+
+        """
+        if not self.profileDir or self.profiling():
+            yield
+            return
+        profile = cProfile.Profile()
+        self._local.profile = profile
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._local.profile = None
+            safeName = re.sub(r'[^\w.-]+', '_', name).strip('_')[:60]
+            path = os.path.join(self.profileDir, '{0}-{1}-{2}.prof'.format(
+                safeName or 'profile', time.strftime('%Y%m%d-%H%M%S'),
+                next(self._profileNumbers)))
+            try:
+                os.makedirs(self.profileDir, exist_ok=True)
+                profile.dump_stats(path)
+            except OSError as e:
+                print("Could not write profile {0}, {1}".format(path, e))
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def snapshot(self):
+        """ Return every metric as a dictionary of name -> list of
+        {'labels': ..., 'value': ...}. Histogram values are dictionaries
+        with the count, sum, mean, max, estimated p50 and p95 and the
+        count of each bucket.
+
+        """
+        with self._lock:
+            counters = list(self._counters.items())
+            histograms = [(key, h.toDict())
+                          for key, h in self._histograms.items()]
+        result = {}
+        for (name, labels), value in sorted(counters + histograms,
+                                            key=lambda item: item[0]):
+            result.setdefault(name, []).append({'labels': dict(labels),
+                                                'value': value})
+        return result
+
+    def toJSON(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def toPrometheus(self):
+        """ Return every metric in the Prometheus text exposition format.
+
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                ((key, (h.bounds, list(h.counts), h.count, h.sum))
+                 for key, h in self._histograms.items()),
+                key=lambda item: item[0])
+        lines = []
+        lastName = None
+        for (name, labels), value in counters:
+            if name != lastName:
+                lines.extend(_header(name, 'counter'))
+                lastName = name
+            lines.append('{0}{1} {2}'.format(_fullName(name),
+                                             _formatLabels(labels), value))
+        for (name, labels), (bounds, counts, count, total) in histograms:
+            if name != lastName:
+                lines.extend(_header(name, 'histogram'))
+                lastName = name
+            fullName = _fullName(name)
+            cumulative = 0
+            for bound, bucketCount in zip(bounds + (float('inf'),), counts):
+                cumulative += bucketCount
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{0}_bucket{1} {2}'.format(
+                    fullName, _formatLabels(labels + (('le', le),)),
+                    cumulative))
+            lines.append('{0}_sum{1} {2!r}'.format(
+                fullName, _formatLabels(labels), total))
+            lines.append('{0}_count{1} {2}'.format(
+                fullName, _formatLabels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """ Write the metrics to path, as Prometheus text if it ends in
+        .prom and as JSON otherwise.
+
+        """
+        text = (self.toPrometheus() if path.endswith('.prom')
+                else self.toJSON() + '\n')
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp, path)
+        except OSError as e:
+            print("Could not write metrics {0}, {1}".format(path, e))
+
+
+def _key(name, labels):
+    # Label values are kept as strings, so keys always sort, even when a
+    # value is None (e.g. the host of a url without one)
+    return (name, tuple(sorted((key, str(value))
+                               for key, value in labels.items())))
+
+
+def _fullName(name):
+    return '{0}_{1}'.format(NAMESPACE, name)
+
+
+def _header(name, kind):
+    lines = []
+    if name in METRIC_HELP:
+        lines.append('# HELP {0} {1}'.format(_fullName(name),
+                                             METRIC_HELP[name]))
+    lines.append('# TYPE {0} {1}'.format(_fullName(name), kind))
+    return lines
+
+
+def _formatLabels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(key, _labelEscapePat.sub(
+            lambda m: '\\n' if m.group() == '\n' else '\\' + m.group(),
+            str(value)))
+        for key, value in labels) + '}'
+
+
+# The metrics shared by the whole application
+metrics = Metrics()
+if METRICS_PATH:
+    atexit.register(metrics.dump, METRICS_PATH)
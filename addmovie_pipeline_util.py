@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 *
+""" Enrichment stages run on a movie after its imdb page is scraped.
+
+Every source of extra information is a Stage: a function that reads some
+fields of a MovieRecord (its inputs) and returns values for others (its
+outputs). Stages are registered with registerStage, and enrichMovie runs
+every stage the movie still needs. A stage waits only for the stages that
+produce its inputs, so independent stages run at the same time on a shared
+thread pool and a title takes as long as its slowest source, not the sum
+of them. A stage that raises or runs past its timeout is reported and
+skipped, together with the stages that need its outputs, while the others
+finish normally. It is tried again the next time the movie is enriched.
+
+The ASIN lookup is the built-in 'amazon' stage. To add another site, add
+its fields to MOVIE_FIELDS in addmovie_record_util and register a stage:
+
+    @registerStage('rottentomatoes', inputs=('title', 'year'),
+                   outputs=('tomatoMeter',))
+    def rottenTomatoesStage(movie, timeout):
+        ...
+        return {'tomatoMeter': score}
+
+"""
+
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from addmovie_metrics_util import metrics
+from addmovie_record_util import MOVIE_FIELDS
+from addmovie_web_util import getAmazonID
+
+# Seconds a stage may run before its result is given up on
+STAGE_TIMEOUT = 15
+# Number of stages of all movies run at the same time
+MAX_STAGE_WORKERS = 16
+
+_fieldNames = frozenset(name for name, default in MOVIE_FIELDS)
+
+
+class Stage:
+    """ One enrichment source.
+
+    Parameters
+    ----------
+    name : string
+    func : function
+        called as func(movie, timeout) on a worker thread. Returns a
+        dictionary with a value other than None for every output. It must not change
+        movie itself, and raises (e.g. StageError) when its source fails,
+        so the stage is tried again later.
+    inputs : tuple
+        fields of the movie func reads. The stage runs after the stages
+        that output them.
+    outputs : tuple
+        fields func fills in. The stage is done once none of them is None.
+    timeout : float
+        seconds the stage may take
+
+    """
+
+    def __init__(self, name, func, inputs, outputs, timeout=STAGE_TIMEOUT):
+        unknown = (set(inputs) | set(outputs)) - _fieldNames
+        if unknown:
+            raise ValueError("stage {0} uses unknown movie fields: {1}"
+                             .format(name, ', '.join(sorted(unknown))))
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.timeout = timeout
+
+    def done(self, movie):
+        return all(getattr(movie, field) is not None
+                   for field in self.outputs)
+
+    def run(self, movie, timeout):
+        with metrics.span(self.name, movie.imdbID):
+            return self.func(movie, timeout)
+
+
+# Registered stages by name, in registration order
+STAGES = {}
+_pool = ThreadPoolExecutor(max_workers=MAX_STAGE_WORKERS)
+# id(movie) -> (Event, statuses) of the enrichMovie call running for it
+_inFlight = {}
+_inFlightLock = threading.Lock()
+
+
+def registerStage(name, inputs, outputs, timeout=STAGE_TIMEOUT):
+    """ Decorator that registers func as the stage name. A stage registered
+    again under the same name replaces the old one.
+
+    """
+    def register(func):
+        STAGES[name] = Stage(name, func, inputs, outputs, timeout)
+        return func
+    return register
+
+
+def unregisterStage(name):
+    STAGES.pop(name, None)
+
+
+def pendingStages(movie, stages=None):
+    """ Return the stages that have not filled in their outputs of movie.
+
+    """
+    if stages is None:
+        stages = list(STAGES.values())
+    return [stage for stage in stages if not stage.done(movie)]
+
+
+def enrichMovie(movie, stages=None, timeout=None):
+    """ Run the pending stages on movie and fill in their outputs. Stages
+    run as soon as the stages producing their inputs are finished. If
+    another thread is already enriching movie, this waits for it instead.
+
+    Parameters
+    ----------
+    movie : MovieRecord
+    stages : list
+        the stages to run, all registered stages if None
+    timeout : float
+        seconds each stage may take, instead of its own timeout
+
+    Returns
+    -------
+    statuses : dictionary
+        stage name -> 'ok', 'error', 'timeout' or 'skipped' for every stage
+        that was pending
+
+    """
+    key = id(movie)
+    with _inFlightLock:
+        running = _inFlight.get(key)
+        if running is None:
+            _inFlight[key] = running = (threading.Event(), {})
+            owner = True
+        else:
+            owner = False
+    done, statuses = running
+    if not owner:
+        done.wait()
+        return dict(statuses)
+    try:
+        statuses.update(_runStages(movie, pendingStages(movie, stages),
+                                   timeout))
+    finally:
+        with _inFlightLock:
+            del _inFlight[key]
+        done.set()
+    return dict(statuses)
+
+
+def _runStages(movie, pending, timeout):
+    statuses = {}
+    # field -> names of the stages that output it
+    producers = {}
+    for stage in pending:
+        for field in stage.outputs:
+            producers.setdefault(field, set()).add(stage.name)
+    waiting = list(pending)
+    # future -> (stage, deadline)
+    running = {}
+    failedFields = set()
+
+    def blocked(stage):
+        active = set(s.name for s in waiting)
+        active.update(s.name for s, deadline in running.values())
+        active.discard(stage.name)
+        return any(producers.get(field, set()) & active
+                   for field in stage.inputs)
+
+    while waiting or running:
+        for stage in [s for s in waiting if not blocked(s)]:
+            waiting.remove(stage)
+            if failedFields.intersection(stage.inputs):
+                statuses[stage.name] = 'skipped'
+                failedFields.update(stage.outputs)
+                continue
+            stageTimeout = timeout if timeout is not None else stage.timeout
+            future = _pool.submit(stage.run, movie, stageTimeout)
+            running[future] = (stage, time.monotonic() + stageTimeout)
+        if not running:
+            # Only stages that wait for each other are left
+            for stage in waiting:
+                statuses[stage.name] = 'skipped'
+            break
+
+        nextDeadline = min(deadline for stage, deadline in running.values())
+        finished, _ = wait(running, max(0.0, nextDeadline - time.monotonic()),
+                           FIRST_COMPLETED)
+        now = time.monotonic()
+        for future, (stage, deadline) in list(running.items()):
+            if future in finished:
+                del running[future]
+                try:
+                    values = future.result() or {}
+                except Exception as e:
+                    print("Stage {0} failed for {1}, {2}"
+                          .format(stage.name, movie.imdbID, e))
+                    statuses[stage.name] = 'error'
+                    failedFields.update(stage.outputs)
+                    continue
+                missing = [field for field in stage.outputs
+                           if values.get(field) is None]
+                if missing:
+                    # Leave the movie as it was, so the stage is run again
+                    print("Stage {0} returned no {1} for {2}"
+                          .format(stage.name, ', '.join(missing),
+                                  movie.imdbID))
+                    metrics.inc('stage_errors_total', stage=stage.name)
+                    statuses[stage.name] = 'error'
+                    failedFields.update(stage.outputs)
+                    continue
+                for field in stage.outputs:
+                    setattr(movie, field, values[field])
+                statuses[stage.name] = 'ok'
+            elif deadline <= now:
+                # The thread finishes on its own, its result is dropped
+                del running[future]
+                print("Stage {0} timed out for {1}"
+                      .format(stage.name, movie.imdbID))
+                metrics.inc('stage_timeouts_total', stage=stage.name)
+                statuses[stage.name] = 'timeout'
+                failedFields.update(stage.outputs)
+    return statuses
+
+
+class StageError(Exception):
+    """ Raised by a stage whose source could not be reached. The stage
+    counts as failed and is run again the next time the movie is enriched.
+
+    """
+
+
+@registerStage('amazon', inputs=('amazonLink', 'title'),
+               outputs=('amazonID',))
+def amazonStage(movie, timeout):
+    """ The ASIN from the amazon link on the imdb page. "" if there is
+    none.
+
+    """
+    amazonID = getAmazonID(movie.amazonLink, movie.title, timeout)
+    if amazonID is None:
+        raise StageError("could not follow the amazon link")
+    return {'amazonID': amazonID}
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 *
+""" Cache and background loader for the movie posters shown in imgPanel.
+
+Posters are kept in two tiers. Decoded PIL images of the most recently shown
+posters are kept in memory (PosterCache.getCached), and the downloaded JPEG
+files are kept on disk so a poster is only downloaded once. PosterLoader
+fetches and decodes posters on a worker thread and puts a PosterLoaded
+message into the GUI queue when one is ready, so the Tk main thread never
+waits on the network or on decoding. It also prefetches the posters of all
+search results while they arrive, so they are usually in memory before the
+user selects them.
+
+"""
+
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+from addmovie_metrics_util import metrics
+from addmovie_queue_util import PosterLoaded
+from addmovie_web_util import getContent
+
+POSTER_URL = os.environ.get('MINISCRAPE_POSTER_URL',
+                            'http://ia.media-imdb.com')
+POSTER_DIR = os.environ.get(
+    'MINISCRAPE_POSTER_DIR',
+    os.path.join(os.path.expanduser('~'), '.miniscrape', 'posters'))
+# Number of decoded posters kept in memory
+MAX_MEMORY_POSTERS = 64
+# Number of posters downloaded at the same time
+MAX_POSTER_WORKERS = 2
+# Number of posters prefetched at the same time for search results
+MAX_PREFETCH_WORKERS = 3
+
+
+def posterURL(imageURL):
+    """ Build the url of the small poster for the imageURL id that bsIMDB
+    extracted from the imdb page.
+
+    """
+    return "{0}/images/M/{1}._V1_"\
+        "SY150_CR3,0,101,150_AL_.jpg".format(POSTER_URL, imageURL)
+
+
+class PosterCache:
+    """ Two tier poster cache: an LRU of decoded images in memory backed by
+    the JPEG files in directory.
+
+    Parameters
+    ----------
+    directory : string
+        where the downloaded JPEG files are stored
+    maxInMemory : int
+        number of decoded images kept in memory
+
+    """
+
+    def __init__(self, directory=POSTER_DIR, maxInMemory=MAX_MEMORY_POSTERS):
+        self.directory = directory
+        self.maxInMemory = maxInMemory
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def path(self, imageURL):
+        name = hashlib.sha1(imageURL.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + '.jpg')
+
+    def getCached(self, imageURL):
+        """ Return the decoded poster if it is in memory, else None.
+        This never blocks, so it is safe to call from the Tk main thread.
+
+        """
+        with self._lock:
+            image = self._images.get(imageURL)
+            if image is not None:
+                self._images.move_to_end(imageURL)
+            return image
+
+    def load(self, imageURL):
+        """ Return the decoded poster from memory, disk or the web, in that
+        order. Returns None if the poster can't be downloaded or decoded.
+        This blocks, call it from a worker thread.
+
+        """
+        image = self.getCached(imageURL)
+        if image is not None:
+            metrics.inc('poster_cache_hits_total', tier='memory')
+            return image
+        with metrics.span('poster', imageURL):
+            path = self.path(imageURL)
+            data = None
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                metrics.inc('poster_cache_hits_total', tier='disk')
+            except OSError:
+                pass
+            if data is None:
+                metrics.inc('poster_cache_misses_total')
+                resp = getContent(posterURL(imageURL))
+                if not resp:
+                    metrics.inc('stage_errors_total', stage='poster')
+                    return None
+                data = resp.read()
+                self._store(path, data)
+            try:
+                image = Image.open(BytesIO(data))
+                image.load()
+            except (OSError, SyntaxError) as e:
+                print("Could not decode poster {0}, {1}".format(imageURL, e))
+                metrics.inc('stage_errors_total', stage='poster')
+                return None
+        self._remember(imageURL, image)
+        return image
+
+    def _store(self, path, data):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = '{0}.{1}.tmp'.format(path, threading.get_ident())
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            print("Could not save poster {0}, {1}".format(path, e))
+
+    def _remember(self, imageURL, image):
+        with self._lock:
+            self._images[imageURL] = image
+            self._images.move_to_end(imageURL)
+            while len(self._images) > self.maxInMemory:
+                self._images.popitem(last=False)
+
+
+class PosterLoader:
+    """ Loads posters on worker threads and hands them to the GUI through
+    its queue as PosterLoaded messages. Their image is None if the poster
+    could not be loaded.
+
+    Parameters
+    ----------
+    queue : queue
+        the GUI queue processed by AddMovieGUI.processIncoming
+    posterCache : PosterCache
+    maxWorkers : int
+        number of posters loaded at the same time
+    maxPrefetchWorkers : int
+        number of posters prefetched at the same time
+
+    """
+
+    def __init__(self, queue, posterCache=None, maxWorkers=MAX_POSTER_WORKERS,
+                 maxPrefetchWorkers=MAX_PREFETCH_WORKERS):
+        self.queue = queue
+        self.cache = posterCache if posterCache is not None else PosterCache()
+        self._pool = ThreadPoolExecutor(max_workers=maxWorkers)
+        self._prefetchPool = ThreadPoolExecutor(max_workers=maxPrefetchWorkers)
+        self._prefetchGeneration = 0
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def request(self, imageURL):
+        """ Start loading imageURL in the background. Requests for a poster
+        that is already being loaded are merged.
+
+        """
+        with self._lock:
+            if imageURL in self._pending:
+                return
+            self._pending.add(imageURL)
+        self._pool.submit(self._load, imageURL)
+
+    def _load(self, imageURL):
+        try:
+            image = self.cache.load(imageURL)
+        except Exception as e:
+            print("Could not load poster {0}, {1}".format(imageURL, e))
+            image = None
+        finally:
+            with self._lock:
+                self._pending.discard(imageURL)
+        self.queue.put(PosterLoaded(imageURL, image))
+
+    def prefetch(self, imageURL):
+        """ Load imageURL into the cache in the background, before it is
+        requested. Prefetches that have not started yet are dropped by
+        cancelPrefetch. This may be called from any thread.
+
+        """
+        if self.cache.getCached(imageURL) is not None:
+            return
+        try:
+            self._prefetchPool.submit(self._prefetch, imageURL,
+                                      self._prefetchGeneration)
+        except RuntimeError:
+            # the loader was shut down while the search was still running
+            pass
+
+    def cancelPrefetch(self):
+        """ Drop all prefetches that have not started yet. Called when a
+        new search starts.
+
+        """
+        self._prefetchGeneration += 1
+
+    def _prefetch(self, imageURL, generation):
+        if generation != self._prefetchGeneration:
+            return
+        with self._lock:
+            if imageURL in self._pending:
+                return
+            self._pending.add(imageURL)
+        self._load(imageURL)
+
+    def shutdown(self):
+        self.cancelPrefetch()
+        self._pool.shutdown(wait=False)
+        self._prefetchPool.shutdown(wait=False)
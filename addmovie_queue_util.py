@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 *
+""" Messages from the worker threads to the GUI, and the queue that carries
+them.
+
+Worker threads never touch Tk widgets. They put one of the message types
+below into the GUI queue, and AddMovieGUI.processIncoming handles it on the
+Tk main thread. GUIQueue wakes the Tk main loop up as soon as a message is
+put, instead of having the main loop poll the queue on a timer. On POSIX
+systems, put writes a byte to a pipe that is registered with Tk's file
+handler. Only one wakeup is pending at a time, and the handler processes
+every message in the queue, so a burst of messages from many workers costs
+a single wakeup. Where Tk has no file handlers (Windows), Tk calls can't be
+made from the worker threads either, so the main loop checks the queue
+every POLL_INTERVAL milliseconds instead.
+
+"""
+
+
+import os
+import queue
+import threading
+import tkinter
+from collections import namedtuple
+
+# A movie of search generation was scraped
+MovieFound = namedtuple('MovieFound', ['generation', 'movie'])
+# All movies of search generation were scraped
+MovieSearched = namedtuple('MovieSearched', ['generation'])
+# A poster finished loading. image is None if it could not be loaded.
+PosterLoaded = namedtuple('PosterLoaded', ['imageURL', 'image'])
+# The enrichment stages of a submitted movie finished. statuses is what
+# enrichMovie returned.
+MovieEnriched = namedtuple('MovieEnriched', ['movie', 'statuses'])
+
+# Milliseconds between two checks of the queue where Tk has no file
+# handlers
+POLL_INTERVAL = 50
+
+
+class GUIQueue(queue.Queue):
+    """ Queue that calls handler on the Tk main thread after a message is
+    put into it, from any thread.
+
+    Parameters
+    ----------
+    master : the root Tk instance
+
+    """
+
+    def __init__(self, master):
+        super().__init__()
+        self.master = master
+        self.handler = None
+        self._wakeupPending = False
+        self._closed = False
+        self._wakeupLock = threading.Lock()
+        self._readFD = self._writeFD = None
+        try:
+            readFD, writeFD = os.pipe()
+        except OSError:
+            readFD = writeFD = None
+        if readFD is not None:
+            os.set_blocking(readFD, False)
+            os.set_blocking(writeFD, False)
+            try:
+                master.tk.createfilehandler(readFD, tkinter.READABLE,
+                                            self._readable)
+            except (AttributeError, RuntimeError, tkinter.TclError):
+                os.close(readFD)
+                os.close(writeFD)
+            else:
+                self._readFD, self._writeFD = readFD, writeFD
+        if self._writeFD is None:
+            master.after(POLL_INTERVAL, self._poll)
+
+    def listen(self, handler):
+        """ Call handler on the Tk main thread whenever messages are put.
+        Messages put before this are handled right away.
+
+        """
+        self.handler = handler
+        if not self.empty():
+            self._notify()
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        self._notify()
+
+    def close(self):
+        """ Stop waking up the main loop. Called when the GUI is closed.
+
+        """
+        with self._wakeupLock:
+            self._closed = True
+            if self._readFD is not None:
+                self.master.tk.deletefilehandler(self._readFD)
+                os.close(self._readFD)
+                os.close(self._writeFD)
+                self._readFD = self._writeFD = None
+
+    def _notify(self):
+        with self._wakeupLock:
+            if (self._wakeupPending or self._closed or
+                    self._writeFD is None):
+                return
+            self._wakeupPending = True
+            try:
+                os.write(self._writeFD, b'\0')
+            except BlockingIOError:
+                # the pipe is full, so a wakeup is on its way anyway
+                pass
+
+    def _poll(self):
+        if self._closed:
+            return
+        if not self.empty():
+            self._wakeup()
+        self.master.after(POLL_INTERVAL, self._poll)
+
+    def _readable(self, fd, mask):
+        try:
+            os.read(fd, 512)
+        except BlockingIOError:
+            pass
+        self._wakeup()
+
+    def _wakeup(self):
+        # Clear the flag first, so messages put while the handler runs
+        # schedule another wakeup instead of being missed
+        with self._wakeupLock:
+            self._wakeupPending = False
+        if self.handler is not None:
+            self.handler()
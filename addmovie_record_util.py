@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 *
+""" The record type for a scraped movie.
+
+bsIMDB returns a MovieRecord, the GUI keeps them in movieList, batch mode
+writes them as JSON lines and insert2DB stores them. Every record has all
+the fields in MOVIE_FIELDS, so code that reads a movie never has to check
+whether a key exists. The fields live in __slots__, which keeps a record
+several times smaller than the equivalent dictionary in large batch jobs.
+
+"""
+
+
+import json
+
+# Every field of a movie and its value when it is not known. None marks
+# fields that are filled in later, and is left out of toDict.
+MOVIE_FIELDS = (
+    ('imdbID', None),
+    ('title', ""),
+    ('year', '0000'),
+    ('type', 'NA'),
+    ('imageURL', ""),
+    # href of the amazon link on the imdb page
+    ('amazonLink', None),
+    # ASIN, filled in by resolveAmazonID. "" if there is none.
+    ('amazonID', None),
+    ('movname', None),
+    ('hashX', None),
+    # movID of the row in the database, set by alreadyExist
+    ('movID_old', None),
+    ('queryStr', None),
+)
+_fieldNames = tuple(name for name, default in MOVIE_FIELDS)
+_defaults = tuple(default for name, default in MOVIE_FIELDS)
+
+
+class MovieRecord:
+    """ One movie. Fields are set as keyword arguments or attributes, see
+    MOVIE_FIELDS.
+
+    Parameters
+    ----------
+    imdbID : string
+        the imdb ID with the 'tt' prefix
+
+    """
+
+    __slots__ = _fieldNames
+
+    def __init__(self, imdbID, **fields):
+        for name, default in zip(_fieldNames, _defaults):
+            setattr(self, name, fields.pop(name, default))
+        self.imdbID = imdbID
+        if fields:
+            raise TypeError("unknown movie fields: {0}"
+                            .format(', '.join(sorted(fields))))
+
+    def values(self):
+        """ Return the values of all fields, in MOVIE_FIELDS order.
+
+        """
+        return tuple(getattr(self, name) for name in _fieldNames)
+
+    def toDict(self):
+        """ Return the fields that are set as a dictionary.
+
+        """
+        return dict((name, value) for name, value in
+                    zip(_fieldNames, self.values()) if value is not None)
+
+    @classmethod
+    def fromDict(cls, fields):
+        fields = dict(fields)
+        return cls(fields.pop('imdbID'), **fields)
+
+    @classmethod
+    def fromValues(cls, values):
+        """ Build a record from the tuple returned by values().
+
+        """
+        movie = cls.__new__(cls)
+        for name, value in zip(_fieldNames, values):
+            setattr(movie, name, value)
+        return movie
+
+    def toJSON(self):
+        return json.dumps(self.toDict())
+
+    def label(self):
+        """ The string shown for the movie in movieListBox.
+
+        """
+        return "{0} {1} {2}".format(self.title, self.year, self.type)
+
+    def __eq__(self, other):
+        if not isinstance(other, MovieRecord):
+            return NotImplemented
+        return self.values() == other.values()
+
+    def __hash__(self):
+        # Equal records have the same imdbID. Don't change the imdbID of a
+        # record that is in a set or used as a key.
+        return hash(self.imdbID)
+
+    def __repr__(self):
+        return 'MovieRecord({0!r})'.format(self.toDict())
@@ -2,7 +2,9 @@
 # -*- coding: utf-8 *
 """ Helper methods for web requests and scraping data from pages.
 
-All web requests are processed by getContent. The methods to build the url,
+All web requests are processed by getContent, which answers them from the
+on-disk cache in addmovie_cache_util when it can and otherwise sends them
+through the pooled keep-alive client in addmovie_http_util. The methods to build the url,
 and get the relevant info from the web pages in IMDB and Bing are all located
 here.
 
@@ -12,43 +14,176 @@ here.
 import os
 import time
 import string
+import html
+import json
+import http.client
 import urllib.parse
-import urllib.request
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # from unidecode import unidecode
 from bs4 import BeautifulSoup
+import lxml.html
+from lxml import etree
+
+from addmovie_http_util import client, REDIRECT_CODES, MAX_REDIRECTS
+from addmovie_cache_util import cache, queryCache, CachingResponse
+from addmovie_index_util import normalizeQuery, getTitleIndex
+from addmovie_metrics_util import metrics
+from addmovie_record_util import MovieRecord
 # from werkzeug.urls import url_fix
 # from makedb.globalz import addhttp_header, downloads_path, getsoup, cursor
 
+_titleWrapperXPath = ('//div[contains(concat(" ", normalize-space(@class), '
+                      '" "), " title_wrapper ")]')
+_segmentLinkXPath = ('//a[contains(concat(" ", normalize-space(@class), '
+                     '" "), " segment-link ")]/@href')
+# Amazon link -> ASIN, filled in by getAmazonID
+_amazonIDs = {}
+_amazonInFlight = {}
+_amazonLock = threading.Lock()
+
+# Fields parseIMDBPage reads from the page. MovieRecord has the values
+# used when they are missing.
+_pageFields = ('title', 'year', 'type', 'imageURL')
+# Fields streamIMDBPage waits for before it stops downloading the page
+_streamFields = _pageFields + ('amazonLink',)
+amazonIDpat_obj = re.compile(r"(B0\d\w+)")
+jsonldPat = re.compile(rb'<script[^>]*type=["\']application/ld\+json["\']'
+                       rb'[^>]*>(.*?)</script>', re.DOTALL | re.IGNORECASE)
+jsonldImagePat = re.compile(r'/images/M/([^/]+?)\._V1')
+segmentLinkPat = re.compile(rb'<a\s[^>]*class=["\'][^"\']*\bsegment-link\b'
+                            rb'[^>]*>', re.IGNORECASE)
+segmentHrefPat = re.compile(rb'href=["\']([^"\']+)["\']', re.IGNORECASE)
+
+# Where the sites are. The benchmarks in bench/ point these at a local
+# stand-in server.
+BING_URL = os.environ.get('MINISCRAPE_BING_URL', 'http://www.bing.com')
+IMDB_URL = os.environ.get('MINISCRAPE_IMDB_URL', 'http://www.imdb.com')
+# Number of IMDB pages fetched and parsed at the same time by bsIMDBMany
+MAX_WORKERS = 5
+# Seconds to wait on a single web request before giving up on it
+REQUEST_TIMEOUT = 10
+# Bytes read at a time by streamIMDBPage
+STREAM_CHUNK_SIZE = 16 * 1024
+
 
-def getContent(url):
-    """ Takes the url and returns the response from urlopen
+def getContent(url, timeout=REQUEST_TIMEOUT, allowPartial=False,
+               maxAge=None):
+    """ Takes the url and returns the response from the response cache or
+    the shared HTTP client.
     Having a separate function avoids checking for exceptions all
     throughout the code.
 
     Parameters
     ----------
     url : string
+    timeout : float
+        seconds to wait for the server before giving up
+    allowPartial : bool
+        the caller only needs the beginning of the body, so a cached
+        response that was only read partly (see closeEarly) may be used
+    maxAge : float
+        seconds a cached response may be old to be used without asking the
+        server, if that is less than the TTL of its host
 
     Returns
     -------
-    resp : HTTPResponse object
+    resp : CachedResponse or CachingResponse object
+        has the same read() and geturl() methods as the urlopen response
 
     """
-    req = urllib.request.Request(url)
-    req.add_header('User-Agent', "'Mozilla/5.0 (Windows NT 6.1; WOW64)")
+    host = urllib.parse.urlsplit(url).hostname
+    entry = cache.get(url)
+    if entry is not None and (not entry.hasBody or
+                              not (entry.complete or allowPartial)):
+        entry = None
+    if entry is not None and cache.isFresh(entry) and (
+            maxAge is None or time.time() - entry.storedAt < maxAge):
+        cached = cache.openResponse(entry)
+        if cached is not None:
+            metrics.inc('cache_hits_total', host=host, kind='fresh')
+            return cached
+        entry = None
+    headers = cache.conditionalHeaders(entry) if entry is not None else None
     try:
-        resp = urllib.request.urlopen(req)
-    except urllib.error.URLError as e:
-        if hasattr(e, 'reason'):
-            print('We failed to reach a server.')
-            print('Reason: ', e.reason)
-        elif hasattr(e, 'code'):
-            print('The server couldn\'t fulfill the request.')
-            print('Error code: ', e.code)
+        resp = client.request(url, headers=headers, timeout=timeout)
+        if resp.status == 304 and entry is not None:
+            # The page did not change since we cached it.
+            resp.read()
+            cache.refresh(entry, resp.headers)
+            cached = cache.openResponse(entry)
+            if cached is not None:
+                metrics.inc('cache_hits_total', host=host,
+                            kind='revalidated')
+                return cached
+            # The body was evicted meanwhile, so download it again
+            resp = client.request(url, timeout=timeout)
+    except (OSError, http.client.HTTPException) as e:
+        print('We failed to reach a server.')
+        print('Reason: ', e)
         return None
-    return resp
+    metrics.inc('cache_misses_total', host=host)
+    if resp.status >= 400:
+        resp.close()
+        print('The server couldn\'t fulfill the request.')
+        print('Error code: ', resp.status)
+        return None
+    return CachingResponse(cache, url, resp)
+
+
+def getFinalURL(url, timeout=REQUEST_TIMEOUT):
+    """ Returns the url that url redirects to, without downloading any page
+    body. Redirects are followed while they stay on the host of url. The
+    first url on another host is returned without requesting it. The result
+    is cached, so repeated lookups are a local read.
+
+    Parameters
+    ----------
+    url : string
+    timeout : float
+        seconds to wait for the server before giving up
+
+    Returns
+    -------
+    finalurl : string
+        empty string if the server could not be reached
+
+    """
+    host = urllib.parse.urlsplit(url).hostname
+    entry = cache.get(url)
+    if entry is not None and cache.isFresh(entry):
+        metrics.inc('cache_hits_total', host=host, kind='fresh')
+        return entry.finalURL
+    metrics.inc('cache_misses_total', host=host)
+    finalurl = url
+    try:
+        for _ in range(MAX_REDIRECTS):
+            resp = client.request(finalurl, timeout=timeout,
+                                  followRedirects=False)
+            location = resp.headers.get('Location')
+            if resp.status not in REDIRECT_CODES or not location:
+                # Don't download the page itself
+                resp.close()
+                break
+            # Redirect bodies are tiny. Reading it lets the connection be
+            # reused.
+            resp.read()
+            resp.close()
+            finalurl = urllib.parse.urljoin(finalurl, location)
+            if urllib.parse.urlsplit(finalurl).hostname != host:
+                break
+    except (OSError, http.client.HTTPException) as e:
+        print('We failed to reach a server.')
+        print('Reason: ', e)
+        return ""
+    if resp.status >= 400:
+        print('The server couldn\'t fulfill the request.')
+        print('Error code: ', resp.status)
+        return ""
+    cache.put(url, finalurl, 200, resp.headers.items())
+    return finalurl
 
 
 def removeDuplicates(seq):
@@ -62,7 +197,9 @@ def removeDuplicates(seq):
 
 def imdbBingSearch(query):
     """ Search query string on Bing. Only get results from the imdb domain name.
-    Return list of imdb IDs
+    Return list of imdb IDs. Results are remembered in queryCache under the
+    normalized query, so searching the same title again doesn't ask Bing.
+    Bing itself is sent the query as it was typed.
 
     Parameters
     ----------
@@ -74,24 +211,191 @@ def imdbBingSearch(query):
         list of imdbID's found by Bing
 
     """
+    query = query.strip()
+    key = normalizeQuery(query)
+    if not key:
+        return []
+    imdbIDs = queryCache.get(key)
+    if imdbIDs is not None:
+        metrics.inc('query_cache_hits_total')
+        return imdbIDs
+    metrics.inc('query_cache_misses_total')
     sitelink_begin = r'imdb\.com/title/tt'
     numResults = 5
     urltitle = urllib.parse.quote("site:\"imdb.com/title\" {0}".format(query))
-    url = 'http://www.bing.com/search?q={query}&go=Submit&qs=n&form=QBRE&'\
+    url = '{bing}/search?q={query}&go=Submit&qs=n&form=QBRE&'\
           'count={numResults}&pq={query}'\
-          .format(query=urltitle, numResults=numResults)
-    resp = getContent(url)
-    if resp:
-        content = resp.read()
-        sitesearch = sitelink_begin + '([0-9]+)/\" h'
-        imdbIDs = re.findall(sitesearch, content.decode())
-        imdbIDs = removeDuplicates(imdbIDs)
-    else:
-        imdbIDs = []
+          .format(bing=BING_URL, query=urltitle, numResults=numResults)
+    with metrics.span('bing_search', query):
+        resp = getContent(url)
+        if resp:
+            content = resp.read()
+            sitesearch = sitelink_begin + '([0-9]+)/\" h'
+            imdbIDs = re.findall(sitesearch, content.decode())
+            imdbIDs = removeDuplicates(imdbIDs)
+            # An empty result may be a changed or blocked page. Ask again
+            # later.
+            if imdbIDs:
+                queryCache.put(key, imdbIDs)
+        else:
+            imdbIDs = []
+    return imdbIDs
+
+
+def imdbSearch(query):
+    """ Return list of imdb IDs for the query string. They are looked up in
+    the offline title index (see addmovie_index_util) if there is one, and
+    on Bing otherwise or if the index has no match.
+
+    Parameters
+    ----------
+    query : the query string
+
+    Returns
+    -------
+    imdbIDs : list
+        list of imdbID's without the 'tt' prefix, best match first
+
+    """
+    titleIndex = getTitleIndex()
+    if titleIndex is not None:
+        with metrics.span('index_search', query):
+            imdbIDs = titleIndex.search(query)
+        if imdbIDs:
+            metrics.inc('index_hits_total')
+            return imdbIDs
+        metrics.inc('index_misses_total')
+    return imdbBingSearch(query)
+
+
+class SeenIDs:
+    """ Set of numeric imdb IDs stored as a bitmap. One bit per possible ID
+    is much smaller than a set of strings when millions of IDs are seen.
+
+    """
+
+    def __init__(self):
+        self._bits = bytearray()
+        self._count = 0
+
+    def add(self, imdbID):
+        """ Add imdbID (without the 'tt' prefix). Returns True if it was not
+        seen before.
+
+        """
+        byte, bit = divmod(int(imdbID), 8)
+        if byte >= len(self._bits):
+            newSize = max(byte + 1, 2 * len(self._bits))
+            self._bits.extend(bytes(newSize - len(self._bits)))
+        mask = 1 << bit
+        if self._bits[byte] & mask:
+            return False
+        self._bits[byte] |= mask
+        self._count += 1
+        return True
+
+    def __contains__(self, imdbID):
+        byte, bit = divmod(int(imdbID), 8)
+        return byte < len(self._bits) and bool(self._bits[byte] & (1 << bit))
+
+    def __len__(self):
+        return self._count
+
+
+titleLinkPat = re.compile(r'/title/tt(\d{7,})')
+# Start of the element holding one title of a list, chart or search result
+# page, in the layouts IMDB has used. Links outside of them (navigation,
+# recommendations, "more like this") are not part of the list.
+listItemPat = re.compile(
+    r'<(?:div|li|td|tr)\s[^>]*class="[^"]*\b(?:lister-item|titleColumn|'
+    r'ipc-metadata-list-summary-item|find-result-item|findResult|'
+    r'cli-parent)\b', re.IGNORECASE)
+# Seconds a cached list page is used without asking IMDB again. Lists
+# change much more often than the title pages they link to.
+CRAWL_MAX_AGE = 60 * 60
+linkTagPat = re.compile(r'<(?:a|link)\s[^>]*>', re.IGNORECASE)
+nextPagePat = re.compile(r'class="[^"]*\b(?:lister-page-next|next-page)\b'
+                         r'|rel="next"', re.IGNORECASE)
+hrefPat = re.compile(r'href="([^"]+)"', re.IGNORECASE)
+
+
+def nextPageURL(url, content):
+    """ Find the link to the next page of an IMDB list, chart or search
+    result page.
+
+    Returns
+    -------
+    nextURL : string
+        absolute url of the next page, or None on the last page
+
+    """
+    for tag in linkTagPat.findall(content):
+        if nextPagePat.search(tag):
+            m = hrefPat.search(tag)
+            if m:
+                return urllib.parse.urljoin(url, html.unescape(m.group(1)))
+    return None
+
+
+def listItemIDs(content):
+    """ Return the imdb ID of every item of an IMDB list, chart or search
+    result page, in page order. Each item is the first title link after the
+    start of its element.
+
+    """
+    starts = [m.start() for m in listItemPat.finditer(content)]
+    imdbIDs = []
+    for start, end in zip(starts, starts[1:] + [len(content)]):
+        m = titleLinkPat.search(content, start, end)
+        if m:
+            imdbIDs.append(m.group(1))
     return imdbIDs
 
 
-def getAmazonURL(link):
+def imdbListIDs(url, maxPages=None, seen=None):
+    """ Crawl an IMDB list, chart or search result url and follow its
+    pagination. Yields the imdb ID of every item of the list, without
+    duplicates, as soon as each page is read. Pages are fetched again once
+    their cached copy is older than CRAWL_MAX_AGE.
+
+    Parameters
+    ----------
+    url : string
+        first page to crawl
+    maxPages : int
+        stop after this many pages. None follows all pages.
+    seen : SeenIDs
+        ID's that are skipped. Pass the same object to several crawls to
+        deduplicate across them.
+
+    Returns
+    -------
+    imdbIDs : generator
+        imdb ID's without the 'tt' prefix
+
+    """
+    seen = seen if seen is not None else SeenIDs()
+    visited = set()
+    pages = 0
+    while url and url not in visited:
+        if maxPages is not None and pages >= maxPages:
+            break
+        visited.add(url)
+        pages += 1
+        resp = getContent(url, maxAge=CRAWL_MAX_AGE)
+        if not resp:
+            break
+        content = resp.read().decode('utf-8', 'replace')
+        imdbIDs = listItemIDs(content)
+        if not imdbIDs and titleLinkPat.search(content):
+            print("No list items found on {0}".format(url))
+        for imdbID in imdbIDs:
+            if seen.add(imdbID):
+                yield imdbID
+        url = nextPageURL(url, content)
+
+
+def getAmazonURL(link, timeout=REQUEST_TIMEOUT):
     """ The link on IMDB to the movie's corresponding amazon page needs to be
     redirected. This function returns the final destination URL on amazon.
 
@@ -100,6 +404,8 @@ def getAmazonURL(link):
     link : string
         this is the path of the url that goes to the movie's amazon page.
         But it's domain name is imdb.com and needs to be redirected.
+    timeout : float
+        seconds to wait for the server before giving up
 
     Returns
     -------
@@ -107,28 +413,24 @@ def getAmazonURL(link):
         the final url with amazon.com domain name for the movie.
 
     """
-    url = 'http://www.imdb.com' + link
-    resp = getContent(url)
-    if resp:
-        finalurl = resp.geturl()
-        return finalurl
-    else:
-        return ""
+    url = IMDB_URL + link
+    with metrics.span('amazon_redirect', url):
+        return getFinalURL(url, timeout)
 
 
-def fancyIMDBpages(imdbDict, soup):
+def fancyIMDBpages(movie, soup):
     """ Same as bsIMDB to extract data from IMDB page except this
     is for promotional movies where the html is different.
 
     Parameters
     ----------
-    imdbDict : dictonary
+    movie : MovieRecord
         contains current information about this movie
     soup : beautiful soup object of imdb page
 
     Returns
     -------
-    imdbDict : dictionary
+    movie : MovieRecord
         contains info about this movie that we got from the imdb page.
 
     """
@@ -136,54 +438,294 @@ def fancyIMDBpages(imdbDict, soup):
     try:
         header = soup.find("h1", {"class": "header"})
         titleStr = header.get_text()
-        imdbDict['title'] = re.sub('\([^\(\)]+\)', '', titleStr).strip()
+        movie.title = re.sub('\([^\(\)]+\)', '', titleStr).strip()
     except (AttributeError, TypeError) as e:
         print("Could not get movie title. Returning. {0}".format(e))
         return None
 
     # Extract the movie's released year
     try:
-        imdbDict["year"] = header.find('a').get_text().strip()
+        movie.year = header.find('a').get_text().strip()
     except (AttributeError, TypeError) as e:
         # The year is not available, this is probably a TV show so ignore this.
-        print("Could not get year for {0}, {1}".format(imdbDict['title'], e))
-        imdbDict["year"] = '0000'
+        print("Could not get year for {0}, {1}".format(movie.title, e))
+        movie.year = '0000'
 
     # Extract the movie's "type". This is usually the movie's rating.
     # This helps me tell the difference between this being a movie or TV show
     try:
         infobar = soup.find("div", {"class": "infobar"})
         movTyp = infobar.find('meta', {'itemprop': 'contentRating'})['content']
-        imdbDict["type"] = movTyp
+        movie.type = movTyp
     except (AttributeError, TypeError) as e:
-        print("Could not get type for {0}, {1}".format(imdbDict['title'], e))
-        imdbDict["type"] = 'NA'
-    return imdbDict
+        print("Could not get type for {0}, {1}".format(movie.title, e))
+        movie.type = 'NA'
+    return movie
 
 
-def bsIMDB(imdbID):
-    """ Extact info about movie from the imdb page and store it in movieList.
+def getAmazonID(amazonOrigLink, title, timeout=REQUEST_TIMEOUT):
+    """ Follow the amazon link found on the imdb page and return the ASIN
+    in the final amazon url. Found ASINs, and links that redirect to a url
+    without one, are memoized per link. Threads asking for a link that is
+    already being resolved wait for that result instead of sending another
+    request.
+
     Parameters
     ----------
-    imdbID : string
-        unique imdb ID for the movie
+    amazonOrigLink : string
+        href of the amazon link on the imdb page. May be None.
+    title : string
+        movie title, used in the error message
 
     Returns
     -------
-    imdbDict : dictionary
-        contains info about this movie that we got from the imdb page.
+    amazonID : string
+        empty string if the movie has no ASIN, None if the redirect could
+        not be followed. Failures are not memoized, so the next call tries
+        again.
+
+    """
+    if not amazonOrigLink:
+        return ""
+    with _amazonLock:
+        if amazonOrigLink in _amazonIDs:
+            return _amazonIDs[amazonOrigLink]
+        done = _amazonInFlight.get(amazonOrigLink)
+        if done is None:
+            _amazonInFlight[amazonOrigLink] = threading.Event()
+    if done is not None:
+        done.wait(timeout)
+        with _amazonLock:
+            return _amazonIDs.get(amazonOrigLink)
+
+    amazonID = None
+    try:
+        finalAmazonURL = getAmazonURL(amazonOrigLink, timeout)
+        if finalAmazonURL:
+            match = amazonIDpat_obj.search(finalAmazonURL)
+            amazonID = match.group(1).strip() if match else ""
+        else:
+            print("Could not get Amazon ASIN for {0}".format(title))
+    finally:
+        with _amazonLock:
+            if amazonID is not None:
+                _amazonIDs[amazonOrigLink] = amazonID
+            _amazonInFlight.pop(amazonOrigLink).set()
+    return amazonID
+
+
+def resolveAmazonID(movie, timeout=REQUEST_TIMEOUT):
+    """ Fill in movie.amazonID from the amazon link bsIMDB found. This
+    is left out of bsIMDB so it only runs for the movies that are used.
+
+    Parameters
+    ----------
+    movie : MovieRecord
+        a movie returned by bsIMDB
+
+    Returns
+    -------
+    amazonID : string
+        None if the ASIN could not be looked up. movie.amazonID is left
+        None then, so it is tried again later.
+
+    """
+    if movie.amazonID is None:
+        movie.amazonID = getAmazonID(movie.amazonLink, movie.title, timeout)
+    return movie.amazonID
+
+
+def imageURLFromHref(imdbImageStr):
+    """ Return the poster id in the url of the imdb image_src link.
+
+    """
+    imageURL_begin = "http:\/\/ia\.media-imdb\.com\/images\/M\/"
+    imageURL_end = "\._V1"
+    m = re.search(imageURL_begin + "(.*)" + imageURL_end, imdbImageStr)
+    return m.group(1)
+
+
+def jsonldFields(script):
+    """ Decode the text of a JSON-LD script block.
+
+    Parameters
+    ----------
+    script : bytes
+
+    Returns
+    -------
+    fields : dictionary
+        the title, year, type and imageURL found in the block. None if the
+        block can't be decoded or has no name.
+
+    """
+    try:
+        data = json.loads(script.decode('utf-8'))
+    except (UnicodeDecodeError, ValueError):
+        return None
+    if isinstance(data, list):
+        data = next((d for d in data if isinstance(d, dict) and 'name' in d),
+                    None)
+    if not isinstance(data, dict) or not data.get('name'):
+        return None
+
+    fields = {'title': html.unescape(data['name']).strip()}
+    year = str(data.get('datePublished', ''))[:4]
+    if year.isdigit():
+        fields['year'] = year
+    if data.get('contentRating'):
+        fields['type'] = html.unescape(data['contentRating'])
+    image = data.get('image')
+    if isinstance(image, dict):
+        image = image.get('url')
+    m = jsonldImagePat.search(image) if isinstance(image, str) else None
+    if m:
+        fields['imageURL'] = m.group(1)
+    return fields
+
+
+def jsonldIMDB(content):
+    """ Read the movie info from the JSON-LD block that imdb embeds in the
+    page head, without building a tree of the page. The amazon link is not
+    in the JSON-LD block, so its anchor tag is found with a regex.
+
+    Parameters
+    ----------
+    content : bytes
+        the imdb page
+
+    Returns
+    -------
+    fields : dictionary
+        contains the fields found in the JSON-LD block (title, year, type,
+        imageURL) and 'amazonLink'. None if the page has no usable JSON-LD
+        block.
 
     """
-    # initialize movie's info dictonary
-    imdbDict = {}
-    imdbDict['imdbID'] = 'tt' + imdbID
-    url = 'http://www.imdb.com/title/tt{imdbID}'.format(imdbID=imdbID)
-    print(url)
-    resp = getContent(url)
-    if resp:
-        content = resp.read()
+    m = jsonldPat.search(content)
+    fields = jsonldFields(m.group(1)) if m else None
+    if fields is None:
+        return None
+
+    link = segmentLinkPat.search(content)
+    href = segmentHrefPat.search(link.group(0)) if link else None
+    fields['amazonLink'] = (html.unescape(href.group(1).decode('utf-8'))
+                            if href else None)
+    return fields
+
+
+def lxmlIMDB(movie, content):
+    """ Fast version of soupIMDB. Builds the page tree with lxml and reads
+    only the few nodes we need with XPath, which is many times faster than
+    building a BeautifulSoup tree of the whole page. Promotional pages are
+    read by _lxmlFancyIMDBpages.
+
+    Parameters
+    ----------
+    movie : MovieRecord
+        contains current information about this movie
+    content : bytes
+        the imdb page
+
+    Returns
+    -------
+    movie : MovieRecord
+        contains info about this movie, with the href of the amazon link
+        in amazonLink. None if the title could not be found in either
+        layout. Use soupIMDB for those pages.
+
+    """
+    try:
+        doc = lxml.html.fromstring(content)
+    except (etree.ParserError, ValueError):
+        return None
+    wrappers = doc.xpath(_titleWrapperXPath)
+    names = wrappers[0].xpath('.//h1[@itemprop="name"]') if wrappers else []
+    titleStr = names[0].text_content() if names else ""
+    movie.title = re.sub('\([^\(\)]+\)', '', titleStr).strip()
+    if not movie.title:
+        return _lxmlFancyIMDBpages(movie, doc)
+
+    # Get the movie's release year
+    years = names[0].xpath('.//a')
+    if years:
+        movie.year = years[0].text_content().strip()
+    else:
+        print("Could not get year for {0}".format(movie.title))
+        movie.year = '0000'
+
+    # Get the movie type/content rating.
+    movTypes = wrappers[0].xpath('.//meta[@itemprop="contentRating"]'
+                                 '/@content')
+    if movTypes:
+        movie.type = movTypes[0]
     else:
+        print("Could not get type for {0}".format(movie.title))
+        movie.type = 'NA'
+
+    # Get imageURL
+    try:
+        imdbImageStr = doc.xpath('//link[@rel="image_src"]/@href')[0]
+        movie.imageURL = imageURLFromHref(imdbImageStr)
+    except (AttributeError, IndexError) as e:
+        print("Could not get IMDB image for {0}, {1}"
+              .format(movie.title, e))
+        movie.imageURL = ""
+
+    # Get the link to the movie's amazon page
+    links = doc.xpath(_segmentLinkXPath)
+    movie.amazonLink = links[0] if links else None
+    return movie
+
+
+def _lxmlFancyIMDBpages(movie, doc):
+    """ lxml version of fancyIMDBpages for promotional pages.
+
+    """
+    headers = doc.xpath('//h1[contains(concat(" ", normalize-space(@class), '
+                        '" "), " header ")]')
+    if not headers:
         return None
+    titleStr = headers[0].text_content()
+    movie.title = re.sub('\([^\(\)]+\)', '', titleStr).strip()
+
+    years = headers[0].xpath('.//a')
+    if years:
+        movie.year = years[0].text_content().strip()
+    else:
+        print("Could not get year for {0}".format(movie.title))
+        movie.year = '0000'
+
+    movTypes = doc.xpath('//div[contains(concat(" ", normalize-space(@class),'
+                         ' " "), " infobar ")]'
+                         '//meta[@itemprop="contentRating"]/@content')
+    if movTypes:
+        movie.type = movTypes[0]
+    else:
+        print("Could not get type for {0}".format(movie.title))
+        movie.type = 'NA'
+    return movie
+
+
+def soupIMDB(movie, content):
+    """ Extract info about the movie from the imdb page with BeautifulSoup.
+    Slower than lxmlIMDB but also handles the promotional pages through
+    fancyIMDBpages.
+
+    Parameters
+    ----------
+    movie : MovieRecord
+        contains current information about this movie
+    content : bytes
+        the imdb page
+
+    Returns
+    -------
+    movie : MovieRecord
+        contains info about this movie, with the href of the amazon link
+        in amazonLink.
+
+    """
     # Create beautiful soup object from imdb page's content
     soup = BeautifulSoup(content, "lxml")
 
@@ -193,56 +735,394 @@ def bsIMDB(imdbID):
         result2 = result.find("h1", {"itemprop": "name"})
         titleStr = result2.get_text()
         titleStr = re.sub('\([^\(\)]+\)', '', titleStr)
-        imdbDict['title'] = titleStr.strip()
+        movie.title = titleStr.strip()
     except (AttributeError, TypeError) as e:
         print("Could not get imdb title, {0}".format(e))
-        imdbDict['title'] = ""
+        movie.title = ""
 
     # The above extraction may not work for some promotional movies with
     # a big splash page. Call fancyIMDBpages in that case.
-    if not imdbDict['title']:
-        return fancyIMDBpages(imdbDict, soup)
+    if not movie.title:
+        return fancyIMDBpages(movie, soup)
 
     # Get the movie's release year
     try:
         year = result2.find('a').get_text()
-        imdbDict["year"] = year.strip()
+        movie.year = year.strip()
     except (AttributeError, TypeError) as e:
-        print("Could not get year for {0}, {1}".format(imdbDict['title'], e))
-        imdbDict["year"] = '0000'
+        print("Could not get year for {0}, {1}".format(movie.title, e))
+        movie.year = '0000'
 
     # Get the movie type/content rating.
     try:
         movType = result.find('meta', {'itemprop': 'contentRating'})['content']
-        imdbDict["type"] = movType
+        movie.type = movType
     except (AttributeError, TypeError) as e:
-        print("Could not get type for {0}, {1}".format(imdbDict['title'], e))
-        imdbDict["type"] = 'NA'
+        print("Could not get type for {0}, {1}".format(movie.title, e))
+        movie.type = 'NA'
 
     # Get imageURL
     try:
         imdbImageStr = soup.find('link', {'rel': 'image_src'}).get('href')
         # print(imdbImageStr)
-        imageURL_begin = "http:\/\/ia\.media-imdb\.com\/images\/M\/"
-        imageURL_end = "\._V1"
-        m = re.search(imageURL_begin + "(.*)" + imageURL_end, imdbImageStr)
-        imdbDict["imageURL"] = m.group(1)
+        movie.imageURL = imageURLFromHref(imdbImageStr)
     except (AttributeError, TypeError) as e:
         print("Could not get IMDB image for {0}, {1}"
-              .format(imdbDict['title'], e))
-        imdbDict["imageURL"] = ""
+              .format(movie.title, e))
+        movie.imageURL = ""
 
-    # Get the amazon ID
-    try:
-        amazonIDpat = r"(B0\d\w+)"
-        amazonIDpat_obj = re.compile(amazonIDpat)
-        amazonOrigLink = soup.find('a', {'class': 'segment-link'}).get('href')
-        finalAmazonURL = getAmazonURL(amazonOrigLink)
-        match = amazonIDpat_obj.search(finalAmazonURL)
-        imdbDict["amazonID"] = match.group(1).strip() if match else ""
-    except (AttributeError, TypeError) as e:
-        print("Could not get Amazon ASIN for {0}, {1}"
-              .format(imdbDict['title'], e))
-        imdbDict["amazonID"] = ""
+    # Get the link to the movie's amazon page
+    link = soup.find('a', {'class': 'segment-link'})
+    movie.amazonLink = link.get('href') if link else None
+    return movie
+
+
+def parseIMDBPage(imdbID, content):
+    """ Extract info about the movie from the imdb page. Reads the JSON-LD
+    block first and only parses the page for the fields it lacks. Pages
+    without JSON-LD are read with the fast lxml parser, and BeautifulSoup
+    (and fancyIMDBpages) is used for pages that lxml can't read.
+
+    Parameters
+    ----------
+    imdbID : string
+        unique imdb ID for the movie, without the 'tt' prefix
+    content : bytes
+        the imdb page
+
+    Returns
+    -------
+    movie : MovieRecord
+        contains info about this movie, with the href of the amazon link
+        in amazonLink (None if there is no link). None if the page could
+        not be parsed.
+
+    """
+    fields = jsonldIMDB(content)
+    if fields is not None:
+        movie = MovieRecord('tt' + imdbID, **fields)
+        if all(key in fields for key in _pageFields):
+            return movie
+        # Only read the page tree for the fields the JSON-LD block lacks
+        domMovie = lxmlIMDB(MovieRecord('tt' + imdbID), content)
+        if domMovie is not None:
+            for key in _pageFields:
+                if key not in fields:
+                    setattr(movie, key, getattr(domMovie, key))
+        return movie
+    movie = lxmlIMDB(MovieRecord('tt' + imdbID), content)
+    if movie is None:
+        movie = soupIMDB(MovieRecord('tt' + imdbID), content)
+    return movie
+
+
+class IMDBFieldTarget:
+    """ lxml parser target that picks the movie info out of an imdb page
+    while it is being fed, chunk by chunk, by streamIMDBPage. It reads the
+    JSON-LD block and the same nodes as lxmlIMDB and _lxmlFancyIMDBpages.
+    complete() tells when every field has been seen, so the rest of the page
+    doesn't need to be downloaded.
+
+    """
+
+    def __init__(self):
+        self.dom = {}
+        self.jsonld = {}
+        self.depth = 0
+        # depth of the open title_wrapper/infobar div, h1 and year link
+        self._wrapper = None
+        self._infobar = None
+        self._h1 = None
+        self._yearLink = None
+        self._script = None
+        self._titleParts = []
+        self._yearParts = []
+        self._scriptParts = []
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        classes = attrib.get('class', '').split()
+        if tag == 'div':
+            if 'title_wrapper' in classes and self._wrapper is None:
+                self._wrapper = self.depth
+            elif 'infobar' in classes and self._infobar is None:
+                self._infobar = self.depth
+        elif tag == 'h1' and self._h1 is None and 'title' not in self.dom:
+            if ((self._wrapper is not None and
+                 attrib.get('itemprop') == 'name') or 'header' in classes):
+                self._h1 = self.depth
+                self._titleParts = []
+                self._yearParts = []
+        elif tag == 'a':
+            if self._h1 is not None and self._yearLink is None and \
+                    not self._yearParts:
+                self._yearLink = self.depth
+            if 'segment-link' in classes and 'amazonLink' not in self.dom:
+                self.dom['amazonLink'] = attrib.get('href')
+        elif tag == 'meta':
+            if (attrib.get('itemprop') == 'contentRating' and
+                    'type' not in self.dom and
+                    (self._wrapper is not None or
+                     self._infobar is not None)):
+                self.dom['type'] = attrib.get('content')
+        elif tag == 'link':
+            if attrib.get('rel') == 'image_src' and 'imageURL' not in self.dom:
+                try:
+                    self.dom['imageURL'] = imageURLFromHref(
+                        attrib.get('href', ''))
+                except AttributeError:
+                    pass
+        elif tag == 'script':
+            if attrib.get('type') == 'application/ld+json' and \
+                    not self.jsonld:
+                self._script = self.depth
+                self._scriptParts = []
+
+    def data(self, data):
+        if self._h1 is not None:
+            self._titleParts.append(data)
+            if self._yearLink is not None:
+                self._yearParts.append(data)
+        elif self._script is not None:
+            self._scriptParts.append(data)
+
+    def end(self, tag):
+        if self.depth == self._yearLink:
+            self._yearLink = None
+            year = ''.join(self._yearParts).strip()
+            if year:
+                self.dom['year'] = year
+        elif self.depth == self._h1:
+            self._h1 = None
+            titleStr = ''.join(self._titleParts)
+            title = re.sub('\([^\(\)]+\)', '', titleStr).strip()
+            if title:
+                self.dom['title'] = title
+        elif self.depth == self._script:
+            self._script = None
+            script = ''.join(self._scriptParts).encode('utf-8')
+            self.jsonld = jsonldFields(script) or {}
+        elif self.depth == self._wrapper:
+            self._wrapper = None
+        elif self.depth == self._infobar:
+            self._infobar = None
+        self.depth -= 1
 
-    return imdbDict
+    def close(self):
+        return self.fields()
+
+    def fields(self):
+        """ The fields seen so far. JSON-LD values win over the DOM ones,
+        like in parseIMDBPage.
+
+        """
+        fields = dict(self.dom)
+        fields.update(self.jsonld)
+        return fields
+
+    def complete(self):
+        fields = self.fields()
+        return all(key in fields for key in _streamFields)
+
+
+def streamIMDBPage(imdbID, timeout=REQUEST_TIMEOUT):
+    """ Download the imdb page in chunks and feed them to IMDBFieldTarget.
+    The download stops as soon as every field has been seen, which is
+    usually well before the end of the page. Pages that don't have all the
+    fields are read to the end and parsed by parseIMDBPage. The whole
+    download is timed as the imdb_page stage and the parsing alone as
+    imdb_parse.
+
+    Parameters
+    ----------
+    imdbID : string
+        unique imdb ID for the movie, without the 'tt' prefix
+    timeout : float
+        seconds to wait on each web request before giving up
+
+    Returns
+    -------
+    movie : MovieRecord
+        contains info about this movie, with the href of the amazon link
+        in amazonLink. None if the page could not be downloaded or parsed.
+
+    """
+    url = '{0}/title/tt{1}'.format(IMDB_URL, imdbID)
+    with metrics.span('imdb_page', url):
+        resp = getContent(url, timeout, allowPartial=True)
+        if not resp:
+            metrics.inc('stage_errors_total', stage='imdb_page')
+            return None
+        target = IMDBFieldTarget()
+        parser = etree.HTMLParser(target=target)
+        chunks = []
+        # Time spent parsing, without the time waiting for the chunks
+        parseTime = 0.0
+        while True:
+            chunk = resp.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            start = time.perf_counter()
+            parser.feed(chunk)
+            parseTime += time.perf_counter() - start
+            if target.complete():
+                resp.closeEarly()
+                metrics.observe('stage_seconds', parseTime,
+                                stage='imdb_parse')
+                return MovieRecord('tt' + imdbID, **target.fields())
+        resp.close()
+        start = time.perf_counter()
+        movie = parseIMDBPage(imdbID, b''.join(chunks))
+        metrics.observe('stage_seconds',
+                        parseTime + time.perf_counter() - start,
+                        stage='imdb_parse')
+    if movie is None:
+        metrics.inc('stage_errors_total', stage='imdb_page')
+    return movie
+
+
+def fetchIMDBPage(imdbID, timeout=REQUEST_TIMEOUT):
+    """ Download the whole imdb page, without parsing it.
+
+    Returns
+    -------
+    content : bytes
+        None if the page could not be downloaded
+
+    """
+    url = '{0}/title/tt{1}'.format(IMDB_URL, imdbID)
+    with metrics.span('imdb_download', url):
+        resp = getContent(url, timeout)
+        if not resp:
+            metrics.inc('stage_errors_total', stage='imdb_download')
+            return None
+        return resp.read()
+
+
+def parseIMDBValues(imdbID, content):
+    """ parseIMDBPage for a process pool worker. Only the field values are
+    sent back to the parent process, not the parse tree or the record.
+
+    Returns
+    -------
+    values : tuple
+        movie.values() of the parsed MovieRecord, None if the page could
+        not be parsed
+    seconds : float
+        time spent parsing
+
+    """
+    start = time.perf_counter()
+    movie = parseIMDBPage(imdbID, content)
+    elapsed = time.perf_counter() - start
+    return (movie.values() if movie is not None else None), elapsed
+
+
+def bsIMDB(imdbID, timeout=REQUEST_TIMEOUT, parsePool=None):
+    """ Extact info about movie from the imdb page and store it in movieList.
+    The amazon link is stored in amazonLink. Call resolveAmazonID to get
+    the ASIN for the movies that need it.
+
+    Parameters
+    ----------
+    imdbID : string
+        unique imdb ID for the movie
+    timeout : float
+        seconds to wait on each web request before giving up
+    parsePool : concurrent.futures.Executor
+        parse the page on this pool, usually a ProcessPoolExecutor so the
+        parsing of many pages uses every core. The page is then downloaded
+        whole in this thread and its bytes are sent to the pool, instead
+        of being parsed while it streams in. None parses it here.
+
+    Returns
+    -------
+    movie : MovieRecord
+        contains info about this movie that we got from the imdb page.
+
+    """
+    if parsePool is None:
+        return streamIMDBPage(imdbID, timeout)
+    content = fetchIMDBPage(imdbID, timeout)
+    if content is None:
+        return None
+    values, elapsed = parsePool.submit(parseIMDBValues, imdbID,
+                                       content).result()
+    metrics.observe('stage_seconds', elapsed, stage='imdb_parse')
+    if values is None:
+        metrics.inc('stage_errors_total', stage='imdb_parse')
+        return None
+    return MovieRecord.fromValues(values)
+
+
+def _scrapeWithCallback(imdbID, timeout, callback, cancelled):
+    if cancelled is not None and cancelled():
+        return None
+    movie = bsIMDB(imdbID, timeout)
+    if cancelled is not None and cancelled():
+        return None
+    if movie and callback is not None:
+        callback(movie)
+    return movie
+
+
+def bsIMDBMany(imdbIDs, maxWorkers=MAX_WORKERS, timeout=REQUEST_TIMEOUT,
+               callback=None, cancelled=None):
+    """ Run bsIMDB for every imdbID at the same time on a pool of worker
+    threads. The results keep the order of imdbIDs (the order Bing returned
+    them in), so the total time is about the time of the slowest page
+    instead of the sum of all of them.
+
+    Parameters
+    ----------
+    imdbIDs : list
+        imdb ID's without the 'tt' prefix, as returned by imdbBingSearch
+    maxWorkers : int
+        number of pages fetched at the same time
+    timeout : float
+        seconds to wait on each web request made for a page
+    callback : function
+        called with each movie on its worker thread as soon as it is
+        scraped, before the other pages are finished
+    cancelled : function
+        returns True once the results are not wanted anymore. Pages that
+        have not started are then skipped, and the ones being scraped are
+        dropped when they finish.
+
+    Returns
+    -------
+    movieList : list
+        MovieRecord for every page that could be scraped, in imdbIDs order
+
+    """
+    if not imdbIDs:
+        return []
+    if metrics.profiling():
+        # cProfile only sees this thread, so scrape the pages here
+        movieList = []
+        for imdbID in imdbIDs:
+            try:
+                movie = _scrapeWithCallback(imdbID, timeout, callback,
+                                            cancelled)
+            except Exception as e:
+                print("Could not scrape tt{0}, {1}".format(imdbID, e))
+                continue
+            if movie:
+                movieList.append(movie)
+        return movieList
+    numWorkers = max(1, min(maxWorkers, len(imdbIDs)))
+    with ThreadPoolExecutor(max_workers=numWorkers) as pool:
+        futures = [pool.submit(_scrapeWithCallback, imdbID, timeout,
+                               callback, cancelled)
+                   for imdbID in imdbIDs]
+        movieList = []
+        for imdbID, future in zip(imdbIDs, futures):
+            try:
+                movie = future.result()
+            except Exception as e:
+                print("Could not scrape tt{0}, {1}".format(imdbID, e))
+                continue
+            if movie:
+                movieList.append(movie)
+    return movieList
@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 *
+""" Call this method to run the scraper without the GUI.
+
+Reads one movie title or IMDB ID (tt0133093 or 0133093) per line from a file
+or stdin. Titles are looked up with imdbSearch, and the IMDB pages are
+scraped with bsIMDB on a pool of worker threads and enriched by the stages in
+addmovie_pipeline_util (the Amazon ASIN). One JSON record is written
+to stdout per line as soon as it's finished, so results stream out in the
+order they complete and memory use does not grow with the size of the input.
+Progress messages and the throughput summary go to stderr.
+
+With --crawl, the IDs are read from IMDB list, chart or search result pages
+instead. Their pagination is followed and every movie found is scraped once,
+while the later pages are still being crawled.
+
+    python batch.py titles.txt > movies.jsonl
+    cat ids.txt | python batch.py -w 16 > movies.jsonl
+    python batch.py --crawl http://www.imdb.com/chart/top > top.jsonl
+
+With --parse-processes N, the worker threads only download the pages and
+N processes parse them, so parsing is not limited to the one core the
+threads share. Use it with more workers than processes, e.g. -w 32
+--parse-processes 4, when the parsing is what keeps the run from going
+faster.
+
+With --journal, every finished line is also appended to a job journal. If
+the job dies, run it again with the same arguments: lines that are done are
+skipped and failed lines are tried again, up to --max-attempts times over
+all runs. The records of every run are written to --output from the journal
+when the job finishes, and replace the file in one step.
+
+    python batch.py ids.txt --journal ids.journal -o movies.jsonl
+
+--metrics writes the timings and counters of addmovie_metrics_util to a
+file when the run is done, and --profile writes a cProfile file per line.
+
+"""
+
+
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    wait, FIRST_COMPLETED
+
+from addmovie_db_util import insert2DB, isKnownID
+from addmovie_http_util import client
+from addmovie_index_util import getTitleIndex
+from addmovie_journal_util import JobJournal, MAX_ATTEMPTS, fsyncDirectory
+from addmovie_metrics_util import metrics
+from addmovie_record_util import MovieRecord
+from addmovie_pipeline_util import enrichMovie
+from addmovie_web_util import imdbSearch, bsIMDB, imdbListIDs, SeenIDs
+
+# Number of lines scraped at the same time
+DEFAULT_WORKERS = 8
+
+imdbIDpat = re.compile(r'^(?:tt)?(\d{7,})$')
+
+
+def readLines(inFile):
+    """ Yield the non-empty lines of inFile that are not comments.
+
+    """
+    for line in inFile:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+
+def hostLimit(value):
+    """ Parse a --host-limit value, HOST=RATE[,BURST[,CONCURRENT]].
+
+    """
+    try:
+        host, limit = value.split('=', 1)
+        parts = limit.split(',')
+        rate = float(parts[0])
+        burst = int(parts[1]) if len(parts) > 1 else max(1, int(rate))
+        maxConcurrent = int(parts[2]) if len(parts) > 2 else DEFAULT_WORKERS
+        if rate <= 0 or burst < 1 or maxConcurrent < 1 or len(parts) > 3:
+            raise ValueError
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "expected HOST=RATE[,BURST[,CONCURRENT]], got " + value)
+    return host, rate, burst, maxConcurrent
+
+
+def crawlLines(urls, maxPages=None):
+    """ Yield 'tt' IDs of all movies linked from the IMDB list pages in
+    urls. IDs found in more than one list are only yielded once.
+
+    """
+    seen = SeenIDs()
+    for url in urls:
+        for imdbID in imdbListIDs(url, maxPages, seen):
+            yield 'tt' + imdbID
+
+
+def _parseWorkerInit():
+    # Worker processes print to the inherited stdout, which holds the
+    # records
+    sys.stdout = sys.stderr
+
+
+def parsePoolFor(processes):
+    """ Return a process pool of processes page parsers, None if
+    processes is 0.
+
+    """
+    if processes <= 0:
+        return None
+    # The pool starts its processes while the worker threads run, and
+    # forking a process with threads that hold locks can hang the child
+    return ProcessPoolExecutor(processes,
+                               multiprocessing.get_context('spawn'),
+                               initializer=_parseWorkerInit)
+
+
+def scrapeLine(line, allResults=False, skipExisting=False, parsePool=None):
+    """ Look up one input line and scrape its IMDB page(s).
+
+    Parameters
+    ----------
+    line : string
+        a movie title or an IMDB ID
+    allResults : bool
+        scrape every search result for a title instead of only the first
+    skipExisting : bool
+        don't scrape movies that are already in the database
+    parsePool : concurrent.futures.Executor
+        parse the pages on this pool, see bsIMDB
+
+    Returns
+    -------
+    records : list
+        one MovieRecord per scraped movie. A dictionary with an 'error' key
+        is returned if nothing was found, and one with a 'skipped' key for
+        movies already in the database. A movie whose enrichment stages
+        failed or timed out is returned as its fields plus an 'error' key,
+        so the line counts as failed and is not stored in the database.
+        Their 'input' holds the line.
+
+    """
+    with metrics.profiled('line-' + line):
+        return _scrapeLine(line, allResults, skipExisting, parsePool)
+
+
+def _scrapeLine(line, allResults, skipExisting, parsePool):
+    m = imdbIDpat.match(line)
+    if m:
+        imdbIDs = [m.group(1)]
+    else:
+        imdbIDs = imdbSearch(line)
+        if not allResults:
+            imdbIDs = imdbIDs[:1]
+    if not imdbIDs:
+        return [{'input': line, 'error': 'no imdb results'}]
+    records = []
+    for imdbID in imdbIDs:
+        if skipExisting and isKnownID('tt' + imdbID):
+            records.append({'input': line, 'imdbID': 'tt' + imdbID,
+                            'skipped': 'already in database'})
+            continue
+        movie = bsIMDB(imdbID, parsePool=parsePool)
+        if movie:
+            statuses = enrichMovie(movie)
+            failedStages = sorted(name for name, status in statuses.items()
+                                  if status in ('error', 'timeout'))
+            if failedStages:
+                record = movie.toDict()
+                record['input'] = line
+                record['error'] = 'stages failed: ' + ', '.join(failedStages)
+                records.append(record)
+            else:
+                records.append(movie)
+        else:
+            records.append({'input': line, 'imdbID': 'tt' + imdbID,
+                            'error': 'could not scrape imdb page'})
+    return records
+
+
+def runBatch(lines, out, workers=DEFAULT_WORKERS, allResults=False,
+             saveToDB=False, skipExisting=False, parseProcesses=0,
+             journal=None):
+    """ Scrape every line on a pool of worker threads and write the records
+    to out as JSON lines as soon as they are done. At most 2 * workers lines
+    are in flight at a time, so lines is read lazily. With saveToDB, every
+    scraped movie is also stored with insert2DB. With skipExisting, movies
+    already in the database are not scraped again. With parseProcesses,
+    the pages are parsed on that many processes instead of in the worker
+    threads. With a JobJournal, lines the journal has done are skipped,
+    every finished line is appended to it, and out may be None.
+
+    Returns
+    -------
+    stats : dictionary
+        number of lines, records and errors, and the lines skipped because
+        the journal had them
+
+    """
+    stats = {'lines': 0, 'records': 0, 'errors': 0, 'skipped': 0,
+             'resumed': 0}
+    maxInFlight = 2 * workers
+
+    def writeDone(done):
+        for future in done:
+            line = inFlight.pop(future)
+            try:
+                records = future.result()
+            except Exception as e:
+                records = [{'input': line, 'error': str(e)}]
+            failed = False
+            dicts = []
+            for record in records:
+                stats['records'] += 1
+                if isinstance(record, MovieRecord):
+                    if saveToDB:
+                        insert2DB(record, verbose=False)
+                    record = record.toDict()
+                    record['input'] = line
+                elif 'error' in record:
+                    stats['errors'] += 1
+                    failed = True
+                else:
+                    stats['skipped'] += 1
+                dicts.append(record)
+            if journal is not None:
+                journal.append(line, dicts, failed)
+            if out is not None:
+                for record in dicts:
+                    out.write(json.dumps(record) + '\n')
+        if out is not None:
+            out.flush()
+
+    inFlight = {}
+    parsePool = parsePoolFor(parseProcesses)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for line in lines:
+                if journal is not None and not journal.shouldRun(line):
+                    stats['resumed'] += 1
+                    continue
+                if len(inFlight) >= maxInFlight:
+                    done, _ = wait(inFlight, return_when=FIRST_COMPLETED)
+                    writeDone(done)
+                inFlight[pool.submit(scrapeLine, line, allResults,
+                                     skipExisting, parsePool)] = line
+                stats['lines'] += 1
+            while inFlight:
+                done, _ = wait(inFlight, return_when=FIRST_COMPLETED)
+                writeDone(done)
+    finally:
+        if parsePool is not None:
+            parsePool.shutdown()
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Scrape IMDB data for movie titles or IMDB IDs and "
+                    "write one JSON record per line to stdout.")
+    parser.add_argument('input', nargs='?', default='-',
+                        help="file with one title or IMDB ID per line "
+                             "(default: stdin)")
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS,
+                        help="number of lines scraped at the same time")
+    parser.add_argument('--parse-processes', type=int, default=0,
+                        metavar='N',
+                        help="parse the pages on N processes, while the "
+                             "worker threads download them")
+    parser.add_argument('--all-results', action='store_true',
+                        help="scrape every search result of a title instead "
+                             "of only the first one")
+    parser.add_argument('--index', metavar='PATH', default=None,
+                        help="look titles up in this offline title index "
+                             "(see addmovie_index_util.py) before Bing")
+    parser.add_argument('--crawl', metavar='URL', action='append',
+                        help="scrape every movie on this IMDB list, chart "
+                             "or search url and its next pages instead of "
+                             "reading input. Can be given more than once.")
+    parser.add_argument('--max-pages', type=int, default=None,
+                        help="number of pages followed per --crawl url")
+    parser.add_argument('--db', action='store_true',
+                        help="also store the movies in the local database")
+    parser.add_argument('--skip-existing', action='store_true',
+                        help="don't scrape movies that are already in the "
+                             "local database")
+    parser.add_argument('--host-limit', metavar='HOST=RATE[,BURST[,N]]',
+                        type=hostLimit, action='append', default=[],
+                        help="send at most RATE requests per second and N "
+                             "at a time to HOST. Can be given more than "
+                             "once.")
+    parser.add_argument('--journal', metavar='PATH',
+                        help="keep a journal of the finished lines in PATH "
+                             "and skip the lines it has when the job is "
+                             "run again. Needs --output.")
+    parser.add_argument('-o', '--output', metavar='PATH',
+                        help="write the records to PATH when the job is "
+                             "done instead of streaming them to stdout")
+    parser.add_argument('--max-attempts', type=int, default=MAX_ATTEMPTS,
+                        help="times a failing line is tried over all runs "
+                             "of a --journal job")
+    parser.add_argument('--metrics', metavar='PATH',
+                        help="write the stage timings and counters to PATH "
+                             "when done, as Prometheus text if it ends in "
+                             ".prom and as JSON otherwise")
+    parser.add_argument('--trace', action='store_true',
+                        help="print the time of every stage to stderr")
+    parser.add_argument('--profile', metavar='DIR',
+                        help="write a cProfile file for every line to DIR")
+    args = parser.parse_args(argv)
+    if args.journal and not args.output:
+        parser.error("--journal needs --output")
+
+    for host, rate, burst, maxConcurrent in args.host_limit:
+        client.setHostLimit(host, rate, burst, maxConcurrent)
+
+    if args.index:
+        getTitleIndex(args.index)
+    if args.trace:
+        metrics.trace = True
+    if args.profile:
+        metrics.profileDir = args.profile
+
+    journal = None
+    tmpOutput = None
+    if args.journal:
+        journal = JobJournal(args.journal, args.max_attempts)
+        done, givenUp = journal.counts()
+        if done or givenUp:
+            print("Resuming {0}: {1} lines done, {2} given up on"
+                  .format(args.journal, done, givenUp), file=sys.stderr)
+        out = None
+    elif args.output:
+        tmpOutput = '{0}.{1}.tmp'.format(args.output, os.getpid())
+        out = open(tmpOutput, 'w', encoding='utf-8')
+    else:
+        out = sys.stdout
+
+    # The scraping helpers print their progress. Keep stdout for the records.
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+
+    if args.crawl:
+        inFile = None
+        lines = crawlLines(args.crawl, args.max_pages)
+    elif args.input == '-':
+        inFile = sys.stdin
+        lines = readLines(inFile)
+    else:
+        inFile = open(args.input, encoding='utf-8')
+        lines = readLines(inFile)
+    start = time.monotonic()
+    try:
+        stats = runBatch(lines, out, max(1, args.workers), args.all_results,
+                         args.db, args.skip_existing, args.parse_processes,
+                         journal)
+        if journal is not None:
+            journal.writeOutput(args.output)
+        elif tmpOutput is not None:
+            out.flush()
+            os.fsync(out.fileno())
+            out.close()
+            os.replace(tmpOutput, args.output)
+            fsyncDirectory(args.output)
+    finally:
+        if inFile is not None and inFile is not sys.stdin:
+            inFile.close()
+        sys.stdout = stdout
+        if journal is not None:
+            journal.close()
+        if tmpOutput is not None and not out.closed:
+            out.close()
+            os.remove(tmpOutput)
+    elapsed = time.monotonic() - start
+    print("{lines} lines, {records} records, {errors} errors, "
+          "{skipped} skipped, {resumed} done before in "
+          "{0:.1f}s ({1:.2f} lines/s)"
+          .format(elapsed, stats['lines'] / elapsed if elapsed else 0.0,
+                  **stats), file=sys.stderr)
+    if args.metrics:
+        metrics.dump(args.metrics)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
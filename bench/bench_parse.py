@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 *
+""" Benchmark the IMDB page parsers on the pages in bench/fixtures.
+
+The fixture pages are synthetic, not captures of imdb.com. They were
+generated to have the markup the parsers look for, in the older title page
+layout (title_wrapper, image_src, contentRating, the amazon link; a
+promotional variant and one with a JSON-LD block), padded to the size of a
+real title page with random filler text, made-up x-meta tags, script
+blocks and cast rows. The timings show how the parsers compare on pages of
+that size, not how fast they are on current IMDB markup.
+
+For every fixture page, the time to extract the movie info is measured for
+the full BeautifulSoup parser (soupIMDB, the old bsIMDB code) and for the
+engine bsIMDB uses now (parseIMDBPage). The extracted fields of both are
+compared so a faster parser that reads the wrong values is noticed.
+
+With --processes, it also measures how many pages per second a process
+pool of each given size parses, like batch.py --parse-processes does.
+
+    python bench/bench_parse.py
+    python bench/bench_parse.py -n 50
+    python bench/bench_parse.py --processes 1 2 4 8
+
+"""
+
+
+import argparse
+import contextlib
+import glob
+import io
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from addmovie_record_util import MovieRecord  # noqa: E402
+from addmovie_web_util import soupIMDB, parseIMDBPage, \
+    parseIMDBValues  # noqa: E402
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'fixtures')
+
+
+def fixturePages(pattern='tt*.html'):
+    """ Return (imdbID, content) of every fixture page. The file name
+    starts with the imdb ID.
+
+    """
+    pages = []
+    for path in sorted(glob.glob(os.path.join(FIXTURE_DIR, pattern))):
+        imdbID = os.path.basename(path)[2:].split('_')[0].split('.')[0]
+        with open(path, 'rb') as f:
+            pages.append((imdbID, f.read()))
+    return pages
+
+
+def timeParser(parse, imdbID, content, number):
+    """ Return the result of parse and the mean seconds per call.
+
+    """
+    # The parsers print missing fields. Keep them out of the report.
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = parse(imdbID, content)
+        start = time.perf_counter()
+        for _ in range(number):
+            parse(imdbID, content)
+        elapsed = time.perf_counter() - start
+    return result, elapsed / number
+
+
+def soupParse(imdbID, content):
+    return soupIMDB(MovieRecord('tt' + imdbID), content)
+
+
+def _quiet():
+    sys.stdout = io.StringIO()
+
+
+def poolThroughput(pages, processes, number):
+    """ Return the pages per second a pool of processes parses, with
+    every page parsed number times.
+
+    """
+    work = pages * number
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(processes, context, initializer=_quiet) as pool:
+        # Start the processes and import the parser before timing
+        list(pool.map(parseIMDBValues, *zip(*pages[:1] * processes)))
+        start = time.perf_counter()
+        list(pool.map(parseIMDBValues, *zip(*work), chunksize=4))
+        elapsed = time.perf_counter() - start
+    return len(work) / elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--number', type=int, default=20,
+                        help="number of times every page is parsed")
+    parser.add_argument('--processes', type=int, nargs='+', default=[],
+                        help="measure the pages per second of process pools "
+                             "of these sizes")
+    args = parser.parse_args(argv)
+
+    print("{0:<24} {1:>8} {2:>12} {3:>12} {4:>8}"
+          .format("page", "KiB", "soup ms", "engine ms", "speedup"))
+    totals = [0.0, 0.0]
+    mismatches = 0
+    for imdbID, content in fixturePages():
+        before, soupTime = timeParser(soupParse, imdbID, content,
+                                      args.number)
+        after, engineTime = timeParser(parseIMDBPage, imdbID, content,
+                                       args.number)
+        totals[0] += soupTime
+        totals[1] += engineTime
+        print("tt{0:<22} {1:>8.0f} {2:>12.2f} {3:>12.2f} {4:>7.1f}x"
+              .format(imdbID, len(content) / 1024, soupTime * 1000,
+                      engineTime * 1000, soupTime / engineTime))
+        if before != after:
+            mismatches += 1
+            print("  results differ:\n    soup:   {0}\n    engine: {1}"
+                  .format(before, after))
+    print("{0:<24} {1:>8} {2:>12.2f} {3:>12.2f} {4:>7.1f}x"
+          .format("total", "", totals[0] * 1000, totals[1] * 1000,
+                  totals[0] / totals[1]))
+    if args.processes:
+        pages = fixturePages()
+        print()
+        print("{0:>10} {1:>12} {2:>8}".format("processes", "pages/s",
+                                              "scaling"))
+        base = None
+        for processes in args.processes:
+            rate = poolThroughput(pages, processes, args.number)
+            base = base or rate / processes
+            print("{0:>10} {1:>12.1f} {2:>7.2f}x"
+                  .format(processes, rate, rate / base))
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 *
+""" Benchmark the scraping pipeline offline against bench/fixture_server.py.
+
+Starts the fixture server on a free local port, points the scraper at it
+and measures
+
+    parse       time to parse every synthetic IMDB page, for the
+                BeautifulSoup parser and the one bsIMDB uses
+    queries     end-to-end latency of a search: imdbBingSearch, bsIMDBMany
+                on the results, the ASIN and the poster of the first one
+    throughput  batch.py's runBatch on a list of IMDB IDs, in lines per
+                second, for several numbers of workers
+
+The pages the fixture server sends are synthetic (see fixture_server.py), so
+the numbers compare versions of the scraper with each other, not with the
+real sites. The response and query caches are disabled unless --warm-cache
+is given, so every run measures the network path. Results are printed as
+tables and can be written as JSON with --json, and a previous JSON file can
+be compared against with --compare.
+
+    python bench/bench_scrape.py --latency 0.05 --json run.json
+    python bench/bench_scrape.py --latency 0.05 --compare run.json
+
+"""
+
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fixture_server import FixtureServer  # noqa: E402
+
+# Numbers of batch workers throughput is measured for
+DEFAULT_LEVELS = (1, 2, 4, 8, 16)
+
+
+def setUp(server, warmCache):
+    """ Keep all state of the run in a temporary directory, point the
+    scraper at server and import it. Returns the temporary directory.
+
+    """
+    tmp = tempfile.mkdtemp(prefix='miniscrape-bench-')
+    os.environ['MINISCRAPE_CACHE_DIR'] = os.path.join(tmp, 'http')
+    os.environ['MINISCRAPE_POSTER_DIR'] = os.path.join(tmp, 'posters')
+    os.environ['MINISCRAPE_DB'] = os.path.join(tmp, 'movies.db')
+    os.environ['MINISCRAPE_TITLE_INDEX'] = os.path.join(tmp, 'titles.idx')
+    os.environ['MINISCRAPE_BING_URL'] = server.url
+    os.environ['MINISCRAPE_IMDB_URL'] = server.url
+    os.environ['MINISCRAPE_POSTER_URL'] = server.url
+
+    from addmovie_cache_util import cache, queryCache
+    from addmovie_http_util import client
+    host = '127.0.0.1'
+    if not warmCache:
+        cache.hostTTLs[host] = 0
+        queryCache.ttl = 0
+    # Measure the scraper, not the politeness limits
+    client.setHostLimit(host, 1e9, 10 ** 9, 10 ** 6)
+    return tmp
+
+
+def forgetASINs():
+    """ Drop the memoized ASINs so every run resolves them again.
+
+    """
+    import addmovie_web_util
+    with addmovie_web_util._amazonLock:
+        addmovie_web_util._amazonIDs.clear()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def benchParse(number):
+    from bench_parse import fixturePages, timeParser, soupParse
+    from addmovie_web_util import parseIMDBPage
+    results = []
+    for imdbID, content in fixturePages():
+        _, soupTime = timeParser(soupParse, imdbID, content, number)
+        _, engineTime = timeParser(parseIMDBPage, imdbID, content, number)
+        results.append({'page': 'tt' + imdbID, 'bytes': len(content),
+                        'soup_ms': soupTime * 1000,
+                        'engine_ms': engineTime * 1000})
+    return results
+
+
+def searchOnce(query, posterDir):
+    """ Run one search like the GUI does and return the seconds it took.
+
+    """
+    from addmovie_poster_util import PosterCache
+    from addmovie_web_util import imdbBingSearch, bsIMDBMany, \
+        resolveAmazonID
+    start = time.perf_counter()
+    movies = bsIMDBMany(imdbBingSearch(query))
+    if movies:
+        resolveAmazonID(movies[0])
+        if movies[0].imageURL:
+            PosterCache(posterDir).load(movies[0].imageURL)
+    return time.perf_counter() - start, len(movies)
+
+
+def benchQueries(server, queries, repeat, tmp):
+    results = []
+    for query in queries:
+        times = []
+        found = 0
+        requests = server.requests
+        for i in range(repeat):
+            forgetASINs()
+            posterDir = os.path.join(tmp, 'posters-{0}-{1}'
+                                     .format(len(results), i))
+            elapsed, found = searchOnce(query, posterDir)
+            times.append(elapsed)
+        results.append({
+            'query': query, 'movies': found,
+            'requests': (server.requests - requests) / repeat,
+            'mean_ms': sum(times) / len(times) * 1000,
+            'p50_ms': percentile(times, 0.5) * 1000,
+            'p95_ms': percentile(times, 0.95) * 1000,
+            'min_ms': min(times) * 1000})
+    return results
+
+
+def benchThroughput(server, numLines, levels, parseProcesses=0):
+    from batch import runBatch
+    imdbIDs = sorted(server.titles)
+    lines = ['tt' + imdbIDs[i % len(imdbIDs)] for i in range(numLines)]
+    results = []
+    for workers in levels:
+        forgetASINs()
+        out = io.StringIO()
+        start = time.perf_counter()
+        stats = runBatch(iter(lines), out, workers,
+                         parseProcesses=parseProcesses)
+        elapsed = time.perf_counter() - start
+        results.append({'workers': workers, 'lines': stats['lines'],
+                        'errors': stats['errors'], 'seconds': elapsed,
+                        'lines_per_s': stats['lines'] / elapsed})
+    return results
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=BENCH_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def printReport(report):
+    print("{0:<16} {1:>8} {2:>10} {3:>10}"
+          .format("page", "KiB", "soup ms", "engine ms"))
+    for r in report['parse']:
+        print("{page:<16} {0:>8.0f} {soup_ms:>10.2f} {engine_ms:>10.2f}"
+              .format(r['bytes'] / 1024, **r))
+    print()
+    print("{0:<28} {1:>6} {2:>6} {3:>9} {4:>9} {5:>9}"
+          .format("query", "movies", "reqs", "p50 ms", "p95 ms", "min ms"))
+    for r in report['queries']:
+        print("{query:<28} {movies:>6} {requests:>6.0f} {p50_ms:>9.1f} "
+              "{p95_ms:>9.1f} {min_ms:>9.1f}".format(**r))
+    print()
+    print("{0:>8} {1:>8} {2:>8} {3:>10}"
+          .format("workers", "lines", "errors", "lines/s"))
+    for r in report['throughput']:
+        print("{workers:>8} {lines:>8} {errors:>8} {lines_per_s:>10.1f}"
+              .format(**r))
+
+
+def compareReports(old, new):
+    """ Print how the main numbers of new changed from old.
+
+    """
+    rows = []
+    pairs = (('parse', 'page', 'engine_ms'), ('queries', 'query', 'p50_ms'),
+             ('throughput', 'workers', 'lines_per_s'))
+    for section, key, metric in pairs:
+        before = dict((r[key], r[metric]) for r in old.get(section, []))
+        for r in new[section]:
+            if r[key] in before and before[r[key]]:
+                rows.append(("{0} {1} {2}".format(section, r[key], metric),
+                             before[r[key]], r[metric]))
+    print()
+    print("{0:<44} {1:>10} {2:>10} {3:>8}"
+          .format("compared to " + old.get('commit', '?'), "before", "now",
+                  "change"))
+    for name, before, now in rows:
+        print("{0:<44} {1:>10.2f} {2:>10.2f} {3:>+7.1f}%"
+              .format(name, before, now, (now / before - 1) * 100))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help="seconds the server delays every response")
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help="up to this many seconds are added at random")
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help="bytes per second the server sends bodies at")
+    parser.add_argument('-n', '--number', type=int, default=10,
+                        help="number of times every page is parsed")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="number of times every query is searched")
+    parser.add_argument('--lines', type=int, default=100,
+                        help="number of IMDB IDs in the throughput run")
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=list(DEFAULT_LEVELS),
+                        help="numbers of batch workers to measure")
+    parser.add_argument('--parse-processes', type=int, default=0,
+                        metavar='N',
+                        help="parse the pages of the throughput run on N "
+                             "processes")
+    parser.add_argument('--warm-cache', action='store_true',
+                        help="let the response and query caches answer "
+                             "repeated requests")
+    parser.add_argument('--json', metavar='PATH',
+                        help="write the results to PATH ('-' for stdout)")
+    parser.add_argument('--compare', metavar='PATH',
+                        help="compare with the results of an earlier run")
+    args = parser.parse_args(argv)
+
+    server = FixtureServer(0, args.latency, args.jitter, args.bandwidth)
+    server.start()
+    tmp = setUp(server, args.warm_cache)
+    queries = [os.path.basename(path) for path in sorted(server.searches)]
+
+    # The scraper prints every url. Keep the report readable.
+    with contextlib.redirect_stdout(io.StringIO()):
+        parse = benchParse(args.number)
+        queryResults = benchQueries(server, queries, args.repeat, tmp)
+        throughput = benchThroughput(server, args.lines, args.workers,
+                                     args.parse_processes)
+    server.shutdown()
+
+    report = {
+        'commit': gitCommit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {'latency': args.latency, 'jitter': args.jitter,
+                   'bandwidth': args.bandwidth, 'number': args.number,
+                   'repeat': args.repeat, 'lines': args.lines,
+                   'parse_processes': args.parse_processes,
+                   'warm_cache': args.warm_cache},
+        'parse': parse,
+        'queries': queryResults,
+        'throughput': throughput,
+    }
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        printReport(report)
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compareReports(json.load(f), report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 *
+""" Local stand-in for the sites the scraper talks to, for benchmarks.
+
+Serves the synthetic pages in bench/fixtures with HTTP/1.1 keep-alive. None
+of them were captured from the real sites. The IMDB pages are generated,
+see bench/bench_parse.py, and the Bing pages are short made-up result
+lists in the shape imdbBingSearch reads:
+
+    /search?q=...          bing_<word>.html for the first <word> in the
+                           query, like the Bing result page
+    /title/tt<ID>          tt<ID>*.html, normal, "fancy" and JSON-LD pages
+    /offsite/?token=...    302 redirect to the amazon page of the ASIN in
+                           the token, like IMDB's amazon links
+    /images/M/...jpg       a generated poster JPEG
+
+Every response waits latency seconds (plus up to jitter) before it is
+sent, and bodies are sent at bandwidth bytes per second if it is set, so
+changes that matter on a slow network show up here too. Point the scraper
+at it with the MINISCRAPE_BING_URL, MINISCRAPE_IMDB_URL and
+MINISCRAPE_POSTER_URL environment variables, or run bench_scrape.py, which
+starts it by itself.
+
+    python bench/fixture_server.py --port 8000 --latency 0.05
+
+"""
+
+
+import argparse
+import glob
+import http.server
+import io
+import os
+import random
+import re
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+
+from PIL import Image
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'fixtures')
+# Bytes written at a time when the bandwidth is limited
+WRITE_CHUNK_SIZE = 4096
+
+titlePathPat = re.compile(r'^/title/tt(\d+)/?$')
+tokenPat = re.compile(r'(B0\w{8})')
+
+
+def loadFixtures(directory=FIXTURE_DIR):
+    """ Return the synthetic IMDB pages by numeric ID and the Bing result
+    pages by the word in their file name.
+
+    """
+    titles = {}
+    for path in glob.glob(os.path.join(directory, 'tt*.html')):
+        imdbID = os.path.basename(path)[2:].split('_')[0].split('.')[0]
+        with open(path, 'rb') as f:
+            titles[imdbID] = f.read()
+    searches = {}
+    for path in sorted(glob.glob(os.path.join(directory, 'bing_*.html'))):
+        word = os.path.basename(path)[len('bing_'):-len('.html')]
+        with open(path, 'rb') as f:
+            searches[word] = f.read()
+    return titles, searches
+
+
+def posterJPEG():
+    """ A JPEG the size of the small posters the GUI shows.
+
+    """
+    image = Image.new('RGB', (101, 150), (40, 60, 90))
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=85)
+    return out.getvalue()
+
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.statsLock:
+            server.requests += 1
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        parts = urllib.parse.urlsplit(self.path)
+        m = titlePathPat.match(parts.path)
+        if parts.path == '/search':
+            query = urllib.parse.parse_qs(parts.query).get('q', [''])[0]
+            body = next((page for word, page in server.searches.items()
+                         if word in query.lower()), None)
+            if body is None and server.searches:
+                body = next(iter(server.searches.values()))
+            self.sendBody(body, 'text/html; charset=utf-8')
+        elif m:
+            self.sendBody(server.titles.get(m.group(1)),
+                          'text/html; charset=utf-8')
+        elif parts.path.startswith('/offsite/'):
+            token = tokenPat.search(parts.query)
+            if token is None:
+                self.sendBody(None, 'text/html')
+                return
+            self.send_response(302)
+            self.send_header('Location', 'https://www.amazon.com/dp/' +
+                             token.group(1))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif parts.path.startswith('/images/M/'):
+            self.sendBody(server.poster, 'image/jpeg')
+        else:
+            self.sendBody(None, 'text/html')
+
+    def sendBody(self, body, contentType):
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        bandwidth = self.server.bandwidth
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+        try:
+            for start in range(0, len(body), WRITE_CHUNK_SIZE):
+                self.wfile.write(body[start:start + WRITE_CHUNK_SIZE])
+                self.wfile.flush()
+                time.sleep(WRITE_CHUNK_SIZE / bandwidth)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client stopped reading early, like streamIMDBPage does
+            self.close_connection = True
+
+
+class FixtureServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """ Threaded HTTP server for the fixtures.
+
+    Parameters
+    ----------
+    port : int
+        0 picks a free port
+    latency : float
+        seconds every response is delayed
+    jitter : float
+        up to this many more seconds are added at random
+    bandwidth : float
+        bytes per second bodies are sent at. 0 for no limit.
+
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, latency=0.0, jitter=0.0, bandwidth=0,
+                 directory=FIXTURE_DIR):
+        super().__init__(('127.0.0.1', port), FixtureHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.titles, self.searches = loadFixtures(directory)
+        self.poster = posterJPEG()
+        self.requests = 0
+        self.statsLock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_address[1])
+
+    def handle_error(self, request, client_address):
+        # Clients close pooled connections whenever they like
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def start(self):
+        """ Serve on a daemon thread and return the base url.
+
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.url
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds every response is delayed")
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help="up to this many seconds are added at random")
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help="bytes per second bodies are sent at")
+    args = parser.parse_args(argv)
+    server = FixtureServer(args.port, args.latency, args.jitter,
+                           args.bandwidth)
+    print("Serving {0} title and {1} search pages on {2}"
+          .format(len(server.titles), len(server.searches), server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
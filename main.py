@@ -3,17 +3,18 @@
 """ Call this method to start the program. 
 
 Start the root Tk instance. Give it to the main worker thread which
-periodically checks the queue for tasks. The worker thread also creates
-AddMovieGUI, which contains the logic for how to handle the queue and
-process tasks.
+creates the queue for tasks. The worker thread also creates AddMovieGUI,
+which contains the logic for how to handle the queue and process tasks.
+The queue wakes the Tk main loop up whenever a task is put into it, see
+addmovie_queue_util.
 
 """
 
 
-import queue
 from tkinter import Tk
 
 from addmovie_gui import AddMovieGUI
+from addmovie_queue_util import GUIQueue
 
 
 class ThreadedClient:
@@ -34,7 +35,7 @@ class ThreadedClient:
         self.master = master
 
         # Create the queue
-        self.queue = queue.Queue()
+        self.queue = GUIQueue(master)
 
         # Set up the GUI part
         self.gui = AddMovieGUI(master, self.queue, self.end_app)
@@ -42,25 +43,16 @@ class ThreadedClient:
         # Set up the thread to do asynchronous I/O
         # More threads can also be created and used, if necessary
         self.running = 1
-        # Start the periodic call in the GUI to check if the queue contains
-        # anything
-        self.periodic_call()
-
-    def periodic_call(self):
-        """ Check every 200 ms if there is something new in the queue.
-        
-        """
-        self.gui.processIncoming()
-        if not self.running:
-            import sys
-            sys.exit(1)
-        self.master.after(100, self.periodic_call)
+        # Let the GUI handle every message as soon as it is put into the
+        # queue
+        self.queue.listen(self.gui.processIncoming)
 
     def end_app(self):
-        """ Call this to end the periodicCall and exit applicaton
+        """ Call this to stop handling the queue and exit applicaton
 
         """
         self.running = 0
+        self.queue.close()
 
 if __name__ == "__main__":
     root = Tk()
@@ -3,10 +3,9 @@
 """ Class for the popup window that asks the user if they want to replace the 
 movie in the DB. 
 
-This currently will not get called because the alreadyExist() method in
-addmovie_db_util is always set to return False. But if not, then a pop up
-window will appear. If the user selects Yes to replace, it then calls
-insert2DB() with the selected movie. If No, it just closes and returns
+This is opened when the alreadyExist() method in addmovie_db_util finds the
+selected movie in the database. If the user selects Yes to replace, it then
+calls insert2DB() with the selected movie. If No, it just closes and returns
 to the AddMovieGUI.
 
 """
@@ -24,7 +23,7 @@ class ReplaceMoviePopUp:
 
         """
         # insert new entry in database
-        insert2DB(self.moviePopUpGUI.movieDict)
+        insert2DB(self.moviePopUpGUI.movie)
         self.top.destroy()
         return"break"
 
@@ -53,21 +52,22 @@ class ReplaceMoviePopUp:
 
         # Warning text label to replace
         warningText = "\"{0}\" already in DB. Replace?"\
-            .format(moviePopUpGUI.movieDict['title'])
-        self.label1 = Label(self.top, text=warningText, height=0, width=50)
+            .format(moviePopUpGUI.movie.title)
+        self.label1 = tki.Label(self.top, text=warningText, height=0,
+                                width=50)
         self.label1.pack()
 
         # Yes Button
         self.yesButton = tkinter.Button(self.top, text="YES", width=20)
         self.yesButton.bind("<Return>", self.replaceMovYes)
         self.yesButton.pack(side='top', padx=0, pady=0)
-        self.searchTextBox.bind("<Down>", self.focus_next_window)
+        self.yesButton.bind("<Down>", self.focus_next_window)
         self.yesButton.focus_set()
 
         # No Button
-        self.noButton = Button(self.top, text="NO", width=20)
+        self.noButton = tki.Button(self.top, text="NO", width=20)
         self.noButton.bind("<Return>", self.quit)
-        self.searchTextBox.bind("<Up>", self.focus_next_window)
+        self.noButton.bind("<Up>", self.focus_next_window)
         self.noButton.pack(side='bottom', padx=0, pady=0)
 
         # Center message box on screen